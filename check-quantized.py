@@ -0,0 +1,64 @@
+import argparse
+import itertools
+
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+import config
+from seada import data, utils, vocab
+from seada.butd import baseline_model as model
+
+
+def make_loader(features_path):
+    questions_path = utils.path_for(val=True, question=True)
+    split = data.VQA(questions_path, utils.path_for(val=True, answer=True), features_path, questions_path, fields=data.MODEL_FIELDS)
+    return data.make_loader(split, config.batch_size)
+
+
+def main():
+    """ Compare the predictions of a trained model on a reduced-precision feature store with those on the float32 store.
+        Both stores should have the same layout (padded or ragged), so that only the precision differs.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoint')
+    parser.add_argument('quantized', help='path of the float16 or int8 store')
+    parser.add_argument('--reference', default=utils.features_path_for(shared=False), help='path of the float32 store')
+    parser.add_argument('--batches', type=int, default=50, help='number of val batches to compare')
+    args = parser.parse_args()
+
+    logs = torch.load(args.checkpoint)
+    # the VQA datasets built from here on use the vocab of the checkpoint
+    vocab.use(logs['vocab'])
+    net = nn.DataParallel(model.Net(logs['vocab']['question'].keys())).cuda()
+    net.module.load_state_dict(logs['weights'])
+    net.eval()
+
+    batches = zip(make_loader(args.reference), make_loader(args.quantized))
+    agree, total, reference_acc, quantized_acc, max_error = 0, 0, 0, 0, 0
+    with torch.no_grad():
+        for reference, quantized in tqdm(itertools.islice(batches, args.batches), total=args.batches, ncols=0):
+            v, q, _, _, a, b, idx, v_mask, q_mask, _, _, _, _, q_len = reference
+            assert (idx == quantized[6]).all(), 'stores are not iterated in the same order'
+            v = data.features_to_cuda(v)
+            v_quantized = data.features_to_cuda(quantized[0])
+            b, q, v_mask, q_mask, q_len = b.cuda(), q.cuda(), v_mask.cuda(), q_mask.cuda(), q_len.cuda()
+            answer = utils.process_answer(a.cuda())
+
+            out = net(v, b, q, v_mask, q_mask, q_len)
+            out_quantized = net(v_quantized, b, q, v_mask, q_mask, q_len)
+            agree += (out.max(1)[1] == out_quantized.max(1)[1]).sum().item()
+            total += out.shape[0]
+            reference_acc += utils.batch_accuracy(out, answer)[0].sum().item()
+            quantized_acc += utils.batch_accuracy(out_quantized, answer)[0].sum().item()
+            max_error = max(max_error, (v - v_quantized).abs().max().item())
+
+    print('questions:                 ', total)
+    print('same prediction:           {:.4f}'.format(agree / total))
+    print('accuracy float32:          {:.4f}'.format(reference_acc / total))
+    print('accuracy reduced precision: {:.4f}'.format(quantized_acc / total))
+    print('max feature error:         {:.4f}'.format(max_error))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,16 @@ bottom_up_trainval_path = '/home/tang/trainval'  # directory containing the .tsv
 bottom_up_test_path = '/home/tang/test2015'  # directory containing the .tsv file(s) with bottom up features
 preprocessed_trainval_path = 'data/genome-trainval.h5'  # path where preprocessed features from the trainval split are saved to and loaded from
 preprocessed_test_path = '/media/tang/新加卷/VQAv2/genome-test.h5'  # path where preprocessed features from the test split are saved to and loaded from
+preprocessed_trainval_mmap_path = 'data/genome-trainval-mmap'  # directory of the memory-mapped trainval features, used when feature_backend = 'mmap'
+preprocessed_test_mmap_path = 'data/genome-test-mmap'  # directory of the memory-mapped test features, used when feature_backend = 'mmap'
+combine_feature_stores = False  # open the trainval and test stores as one logical store that the loaders of all splits share
+feature_stripes = None  # directories (one per drive) that preprocess-features.py stripes the mmap store across, the store path then only holds the list of stripes
+shared_features = None  # name of a node-wide shared-memory copy of the feature stores (filled once by data/share-features.py) to attach to instead of the paths above
 vocabulary_path = '/home/tang/attack_on_VQA2.0-Recent-Approachs-2018/data/vocab.json'  # path where the used vocabularies for question and answers are saved to
 glove_index = 'data/dictionary.pkl'
+compiled_vocab_path = 'data/vocab-compiled'  # directory of the question (glove_index) and answer (vocabulary_path) vocabularies compiled into arrays, rebuilt whenever either changes
+shards_path = 'data/shards'  # directory with one directory of tar shards per split, written by data/make-shards.py
+qa_cache_path = 'data/qa-cache'  # directory where the parsed and encoded questions and answers are cached, keyed by a hash of the jsons and the vocab; None disables the cache
 result_json_path = 'results.json'  # the path to save the test json that can be uploaded to vqa2.0 online evaluation server
 paraphrase_save_path = 'data/v2_OpenEnded_mscoco_train2014_questions_adv.json'
 
@@ -17,6 +25,8 @@ test_split = 'test2015'  # always 'test2015' since from 2018, vqa online evaluat
 # preprocess config
 output_size = 100  # max number of object proposals per image
 output_features = 2048  # number of features in each object proposal
+feature_backend = 'h5'  # 'h5' or 'mmap' (flat [num_obj, 2048] row-major file, sliced without copies), written by preprocess-features.py and read by the VQA dataset
+pad_objects = 'fixed'  # images of a ragged store (preprocess-features.py --ragged) are padded to output_size ('fixed', same outputs as a padded store) or to the most boxes in their batch ('batch', faster, but the attention is not masked so outputs depend on the padding and differ from models trained on padded stores)
 
 ###################################################################
 #              Default Setting for All Model
@@ -29,10 +39,21 @@ lr_decay_step = 2
 lr_decay_rate = 0.25
 lr_halflife = 50000 # for scheduler (counting)
 data_workers = 4
+persistent_workers = True  # keep the data workers alive across epochs (needs torch >= 1.7, ignored otherwise)
+batch_transport = 'queue'  # 'queue' sends batches from the data workers through torch's multiprocessing queues, 'ring' through a preallocated, pinned shared-memory ring buffer that is read in place
+ring_buffer_slots = 8  # with batch_transport = 'ring', number of batches that can be in flight at once
+batch_sampler = None  # None shuffles questions independently, 'image' batches the questions of an image together so its features are read once per batch, 'length' batches questions of similar length
+max_questions_per_image = 10  # with batch_sampler = 'image', at most this many questions of one image are kept together
+length_bucket_batches = 100  # with batch_sampler = 'length', training questions are shuffled in buckets of this many batches that are then sorted by length
+batch_source = 'store'  # 'store' reads training images from the feature store at random, 'shards' streams them sequentially from the tar shards under shards_path (ignores batch_sampler and batch_transport)
+shard_shuffle_images = 1000  # with batch_source = 'shards', number of images in the shuffle buffer of every data worker
+feature_cache_bytes = 0  # byte budget of the LRU cache of loaded images kept by every data worker (h5 stores only, mmap stores are served by the page cache), 0 disables it
+sort_batch_reads = False  # read the images of a batch in storage order, coalescing adjacent rows into one read (helps on spinning disks and network filesystems)
 max_answers = 3129
 max_q_length = 666 # question_length = min(max_q_length, max_length_in_dataset)
 clip_value = 0.25
 v_feat_norm = False # Only useful in learning to count
+v_feat_prenormalized = False  # the feature store was built with preprocess-features.py --normalize_features, so v_feat_norm is already applied
 print_gradient = False
 normalize_box = False
 seed = 5225
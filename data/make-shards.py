@@ -0,0 +1,73 @@
+import sys
+import argparse
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from seada import data, features, shards, utils
+
+
+def main():
+    """ Write the images of a split into tar shards for batch_source = 'shards'.
+        Every shard holds `--images_per_shard` random images of the split, each with its features, boxes
+        and the ids of its questions, so a training loader reads it front to back in one sequential pass.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--split', default='train', choices=['train', 'val', 'trainval', 'test'])
+    parser.add_argument('--images_per_shard', type=int, default=1000)
+    args = parser.parse_args()
+
+    split_flags = {args.split: True}
+    test = args.split == 'test'
+    # all questions of the split, the loaders skip the ones they don't use
+    questions_path, answers_path, _ = data.qa_paths_for(**split_flags)
+    split = data.VQA(
+        questions_path,
+        answers_path,
+        utils.features_path_for(test=test, shared=False),
+        dummy_answers=test,
+    )
+    store = split.features
+    coco_ids = np.asarray(split.coco_ids)
+    question_ids = np.asarray(split.question_ids)
+    order = np.argsort(coco_ids, kind='stable')
+    image_ids, starts = np.unique(coco_ids[order], return_index=True)
+    questions_of = dict(zip(image_ids.tolist(), np.split(question_ids[order], starts[1:])))
+    # random images in every shard, so that shuffling whole shards shuffles the images as well
+    image_ids = image_ids[np.random.RandomState(config.seed).permutation(len(image_ids))]
+    rows = store.id_index().rows_of(image_ids)
+
+    shard_dir = shards.shards_dir_for(args.split)
+    os.makedirs(shard_dir, exist_ok=True)
+    names = []
+    for start in tqdm(range(0, len(image_ids), args.images_per_shard)):
+        images = []
+        for image_id, row in zip(image_ids[start:start + args.images_per_shard].tolist(), rows[start:start + args.images_per_shard]):
+            v, b, obj_mask, width, height = store.load(row)
+            num_boxes = int(obj_mask.sum())
+            if isinstance(v, features.QuantizedFeatures):
+                v = features.dequantize(v)
+            v = v[:num_boxes].numpy()
+            images.append((image_id, int(width), int(height), v, b[:num_boxes].numpy(), questions_of[image_id]))
+        name = '{}-{:05d}.tar'.format(args.split, len(names))
+        shards.write_shard(os.path.join(shard_dir, name), images)
+        names.append(name)
+
+    meta = {
+        'shards': names,
+        'num_images': len(image_ids),
+        'num_questions': len(question_ids),
+        'normalized_boxes': store.normalized_boxes,
+        'normalized_features': store.normalized_features,
+    }
+    # written last, like the meta.json of a feature store
+    with open(os.path.join(shard_dir, 'meta.json'), 'w') as fd:
+        json.dump(meta, fd)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,79 +1,174 @@
 import sys
 import argparse
 import base64
+import collections
+import json
+import multiprocessing
 import os
-import csv
-import itertools
 
-csv.field_size_limit(sys.maxsize)
-
-import h5py
-import torch.utils.data
 import numpy as np
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
-import data
-import utils
+from seada import features
+
+
+FIELDNAMES = ['image_id', 'image_w','image_h','num_boxes', 'boxes', 'features']
+
+
+def decode_rows(lines, normalize_boxes=False, normalize_features=False):
+    """ Decode a chunk of bottom-up tsv rows into (image_id, width, height, features, boxes) tuples,
+        optionally with the boxes divided by the image size and the features L2-normalized per box
+    """
+    rows = []
+    for line in lines:
+        item = dict(zip(FIELDNAMES, line.rstrip('\r\n').split('\t')))
+
+        buf = base64.b64decode(item['features'])
+        image_features = np.frombuffer(buf, dtype='float32').reshape((-1, config.output_features))
+
+        buf = base64.b64decode(item['boxes'])
+        boxes = np.frombuffer(buf, dtype='float32').reshape((-1, 4))
+
+        width, height = int(item['image_w']), int(item['image_h'])
+        if normalize_boxes:
+            boxes = boxes / np.array([width, height, width, height], dtype='float32')
+        if normalize_features:
+            image_features = image_features / (np.linalg.norm(image_features, axis=1, keepdims=True) + 1e-12)
+
+        rows.append((int(item['image_id']), width, height, image_features, boxes))
+    return rows
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def decode_in_order(pool, lines, chunk_size, depth, options=()):
+    """ Decode rows in the worker pool while keeping their order.
+        At most `depth` chunks are in flight, so that the tsv is never read much ahead of the writer.
+        `options` are passed on to decode_rows.
+    """
+    pending = collections.deque()
+    for chunk in iter_chunks(lines, chunk_size):
+        pending.append(pool.apply_async(decode_rows, (chunk,) + tuple(options)))
+        if len(pending) >= depth:
+            yield from pending.popleft().get()
+    while pending:
+        yield from pending.popleft().get()
+
+
+def skip(lines, n):
+    for i, line in enumerate(lines):
+        if i >= n:
+            yield line
+
+
+class Progress:
+    """ Rows of every tsv file that are safely in the store, saved next to the store after every checkpoint.
+        It is kept after a finished build, so that running again only adds tsv files that are new.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.done = set()
+        self.num_images = 0
+        self.options = {}
+        if os.path.exists(path):
+            with open(path, 'r') as fd:
+                state = json.load(fd)
+            self.files = state['files']
+            self.done = set(state['done'])
+            self.num_images = state['num_images']
+            self.options = state['options']
+
+    def save(self):
+        state = {'files': self.files, 'done': sorted(self.done), 'num_images': self.num_images, 'options': self.options}
+        with open(self.path + '.tmp', 'w') as fd:
+            json.dump(state, fd)
+        os.replace(self.path + '.tmp', self.path)
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--test', action='store_true')
+    parser.add_argument('--backend', default=config.feature_backend, choices=['h5', 'mmap'],
+                        help='layout of the written store, see config.feature_backend')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of decoding processes')
+    parser.add_argument('--checkpoint_every', type=int, default=1000, help='images between two progress checkpoints')
+    parser.add_argument('--restart', action='store_true', help='ignore previous progress and rebuild the store from scratch')
+    parser.add_argument('--ragged', action='store_true',
+                        help='only store the real boxes of every image instead of padding them to config.output_size (mmap backend)')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'int8'],
+                        help='precision of the stored features, int8 keeps a float32 scale per box (mmap backend)')
+    parser.add_argument('--stripes', nargs='+', default=config.feature_stripes,
+                        help='directories (one per drive) to stripe the store across, image i goes to stripe i % N (mmap backend)')
+    parser.add_argument('--normalize_boxes', action='store_true',
+                        help='store the boxes divided by the image size, as used with config.normalize_box')
+    parser.add_argument('--normalize_features', action='store_true',
+                        help='store the features L2-normalized per box, as used with config.v_feat_norm')
     args = parser.parse_args()
 
-    FIELDNAMES = ['image_id', 'image_w','image_h','num_boxes', 'boxes', 'features']
-
-    features_shape = (
-        82783 + 40504 if not args.test else 81434,  # number of images in trainval or in test
-        config.output_features,
-        config.output_size,
-    )
-    boxes_shape = (
-        features_shape[0],
-        4,
-        config.output_size,
-    )
+    if not args.test:
+        path = config.preprocessed_trainval_mmap_path if args.backend == 'mmap' else config.preprocessed_trainval_path
+    else:
+        path = config.preprocessed_test_mmap_path if args.backend == 'mmap' else config.preprocessed_test_path
+    # the trainval and test stores get a directory of their own on every drive
+    stripes = [os.path.join(stripe, 'test' if args.test else 'trainval') for stripe in args.stripes] if args.stripes else None
+    progress_path = path.rstrip(os.sep) + '.progress.json'
+    if args.restart and os.path.exists(progress_path):
+        os.remove(progress_path)
+    progress = Progress(progress_path)
+    options = {'ragged': args.ragged, 'dtype': args.dtype,
+               'normalize_boxes': args.normalize_boxes, 'normalize_features': args.normalize_features, 'stripes': stripes}
+    # progress of stores built before the normalization options existed has no entry for them
+    previous = dict({'normalize_boxes': False, 'normalize_features': False, 'stripes': None}, **progress.options)
+    if progress.options and previous != options:
+        parser.error('{} was built with {}, pass the same options or --restart'.format(path, progress.options))
+    progress.options = options
+    writer = features.create_features(path, backend=args.backend, append=os.path.exists(progress_path),
+                                      ragged=args.ragged, dtype=args.dtype,
+                                      normalized_boxes=args.normalize_boxes, normalized_features=args.normalize_features,
+                                      stripes=stripes)
+    # anything written after the last checkpoint of an interrupted run is redone
+    writer.truncate(progress.num_images)
 
     if not args.test:
-        path = config.preprocessed_trainval_path
+        tsv_path = config.bottom_up_trainval_path
     else:
-        path = config.preprocessed_test_path
-    with h5py.File(path, libver='latest') as fd:
-        features = fd.create_dataset('features', shape=features_shape, dtype='float32')
-        boxes = fd.create_dataset('boxes', shape=boxes_shape, dtype='float32')
-        coco_ids = fd.create_dataset('ids', shape=(features_shape[0],), dtype='int32')
-        widths = fd.create_dataset('widths', shape=(features_shape[0],), dtype='int32')
-        heights = fd.create_dataset('heights', shape=(features_shape[0],), dtype='int32')
-
-        readers = []
-        if not args.test:
-            path = config.bottom_up_trainval_path
-        else:
-            path = config.bottom_up_test_path
-        for filename in os.listdir(path):
-            if not '.tsv' in filename:
+        tsv_path = config.bottom_up_test_path
+    filenames = sorted(filename for filename in os.listdir(tsv_path) if '.tsv' in filename)
+
+    with multiprocessing.Pool(args.workers) as pool:
+        for filename in filenames:
+            if filename in progress.done:
                 continue
-            full_filename = os.path.join(path, filename)
-            fd = open(full_filename, 'r')
-            reader = csv.DictReader(fd, delimiter='\t', fieldnames=FIELDNAMES)
-            readers.append(reader)
-
-        reader = itertools.chain.from_iterable(readers)
-        for i, item in enumerate(tqdm(reader, total=features_shape[0])):
-            coco_ids[i] = int(item['image_id'])
-            widths[i] = int(item['image_w'])
-            heights[i] = int(item['image_h'])
-
-            buf = base64.decodestring(item['features'].encode('utf8'))
-            array = np.frombuffer(buf, dtype='float32')
-            array = array.reshape((-1, config.output_features)).transpose()
-            features[i, :, :array.shape[1]] = array
-
-            buf = base64.decodestring(item['boxes'].encode('utf8'))
-            array = np.frombuffer(buf, dtype='float32')
-            array = array.reshape((-1, 4)).transpose()
-            boxes[i, :, :array.shape[1]] = array
+            rows_done = progress.files.get(filename, 0)
+            with open(os.path.join(tsv_path, filename), 'r') as fd:
+                rows = decode_in_order(pool, skip(fd, rows_done), chunk_size=16, depth=4 * args.workers,
+                                       options=(args.normalize_boxes, args.normalize_features))
+                for row in tqdm(rows, desc=filename, initial=rows_done):
+                    writer.append(*row)
+                    rows_done += 1
+                    if rows_done % args.checkpoint_every == 0:
+                        writer.flush()
+                        progress.files[filename] = rows_done
+                        progress.num_images = len(writer)
+                        progress.save()
+            writer.flush()
+            progress.files[filename] = rows_done
+            progress.done.add(filename)
+            progress.num_images = len(writer)
+            progress.save()
+    writer.close()
 
 
 if __name__ == '__main__':
@@ -1,22 +1,33 @@
+import sys
 import argparse
+import collections
+import itertools
 import json
+import multiprocessing
+import os
 from collections import Counter
-import itertools
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
-import data
-import utils
+from seada import data, utils, vocab
+
 
+# splits a vocabulary can be built over, as the arguments of utils.path_for of each of their parts
+SPLITS = {
+    'train': [{'train': True}],
+    'trainval': [{'train': True}, {'val': True}],
+    'vqacp-train': [{'train': True, 'vqacp': True}],
+}
 
-def extract_vocab(iterable, top_k=None, start=0):
-    """ Turns an iterable of list of tokens into a vocabulary.
+
+def extract_vocab(counter, top_k=None, start=0):
+    """ Turns a Counter of tokens into a vocabulary.
         These tokens could be single answers or word tokens in questions.
     """
-    all_tokens = itertools.chain.from_iterable(iterable)
-    counter = Counter(all_tokens)
+    # ties at the top_k cutoff go to the tokens seen first, as in a single pass over the json: the chunk
+    # counters are merged in the order the chunks were read
     if top_k:
-        most_common = counter.most_common(top_k)
-        most_common = (t for t, c in most_common)
+        most_common = (t for t, c in counter.most_common(top_k))
     else:
         most_common = counter.keys()
     # descending in count, then lexicographical order
@@ -25,27 +36,79 @@ def extract_vocab(iterable, top_k=None, start=0):
     return vocab
 
 
+def count_question_tokens(questions):
+    return Counter(itertools.chain.from_iterable(map(data.tokenize_question, questions)))
+
+
+def count_answers(answer_lists):
+    return Counter(data.process_punctuation(a) for answer_list in answer_lists for a in answer_list)
+
+
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def count_file(pool, path, question, chunk_size, depth):
+    """ Count the question tokens of a `question` json or the answers of an annotation json, streamed in chunks to the pool.
+        At most `depth` chunks are in flight, so that the json is never read much ahead of the counting.
+    """
+    if question:
+        items = (q['question'] for q in utils.iter_json_array(path, 'questions'))
+        count = count_question_tokens
+    else:
+        items = ([a['answer'] for a in ans['answers']] for ans in utils.iter_json_array(path, 'annotations'))
+        count = count_answers
+    counter = Counter()
+    pending = collections.deque()
+    for chunk in iter_chunks(items, chunk_size):
+        pending.append(pool.apply_async(count, (chunk,)))
+        if len(pending) >= depth:
+            counter.update(pending.popleft().get())
+    while pending:
+        counter.update(pending.popleft().get())
+    return counter
+
+
+def vocab_path_for(split):
+    """ config.vocabulary_path for the train split, next to it with the name of the split for the others """
+    if split == 'train':
+        return config.vocabulary_path
+    root, ext = os.path.splitext(config.vocabulary_path)
+    return '{}-{}{}'.format(root, split, ext)
+
+
 def main():
-    questions = utils.path_for(train=True, question=True)
-    answers = utils.path_for(train=True, answer=True)
-
-    with open(questions, 'r') as fd:
-        questions = json.load(fd)
-    with open(answers, 'r') as fd:
-        answers = json.load(fd)
-
-    questions = list(data.prepare_questions(questions))
-    answers = list(data.prepare_answers(answers))
-
-    question_vocab = extract_vocab(questions, start=1)
-    answer_vocab = extract_vocab(answers, top_k=config.max_answers)
-
-    vocabs = {
-        'question': question_vocab,
-        'answer': answer_vocab,
-    }
-    with open(config.vocabulary_path, 'w') as fd:
-        json.dump(vocabs, fd)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--splits', nargs='+', default=['train'], choices=sorted(SPLITS),
+                        help='splits to build a vocabulary over, every json is read only once')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of tokenizing processes')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='questions per chunk sent to a worker')
+    args = parser.parse_args()
+
+    counters = {}
+    with multiprocessing.Pool(args.workers) as pool:
+        for split in args.splits:
+            questions = [utils.path_for(question=True, **part) for part in SPLITS[split]]
+            answers = [utils.path_for(answer=True, **part) for part in SPLITS[split]]
+            for paths, question in ((questions, True), (answers, False)):
+                for path in paths:
+                    if path not in counters:
+                        counters[path] = count_file(pool, path, question, args.chunk_size, depth=4 * args.workers)
+
+            vocabs = {
+                'question': extract_vocab(sum((counters[path] for path in questions), Counter()), start=1),
+                'answer': extract_vocab(sum((counters[path] for path in answers), Counter()), top_k=config.max_answers),
+            }
+            with open(vocab_path_for(split), 'w') as fd:
+                json.dump(vocabs, fd)
+            if split == 'train':
+                # compiled right away, instead of by the first training run
+                vocab.compile_vocab()
 
 
 if __name__ == '__main__':
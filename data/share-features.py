@@ -0,0 +1,53 @@
+import sys
+import argparse
+import os
+import shutil
+
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from seada import features, utils
+
+
+def main():
+    """ Fill a node-wide shared-memory copy of the preprocessed features that every training job on the node
+        can attach to read-only by setting config.shared_features to the same name.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', default=config.shared_features, help='name the VQA datasets attach to')
+    parser.add_argument('--test', action='store_true')
+    parser.add_argument('--remove', action='store_true', help='free the shared memory again')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'int8'],
+                        help='precision of the shared features, see preprocess-features.py')
+    args = parser.parse_args()
+    if not args.name:
+        parser.error('--name is required when config.shared_features is not set')
+
+    path = features.shared_features_path(args.name, test=args.test)
+    if args.remove:
+        # jobs that are still attached keep their mappings until they exit
+        shutil.rmtree(path)
+        return
+    if os.path.exists(path):
+        print('{} is already filled'.format(path))
+        return
+
+    source = features.open_features(utils.features_path_for(test=args.test, shared=False))
+    ids = source.ids()
+    # fill a private directory first and rename it at the end, so nobody can attach to a half-filled store
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    # same layout as the source, so that attaching to the copy doesn't change how batches are padded (see config.pad_objects)
+    writer = features.MmapFeatureWriter(tmp_path, ragged=source.ragged, dtype=args.dtype, normalized_boxes=source.normalized_boxes,
+                                        normalized_features=source.normalized_features)
+    for i in tqdm(range(len(ids))):
+        v, b, obj_mask, width, height = source.load(i)
+        num_boxes = int(obj_mask.sum())
+        v = features.dequantize(v)
+        writer.append(ids[i], width, height, v[:num_boxes].numpy(), b[:num_boxes].numpy())
+    writer.close()
+    os.rename(tmp_path, path)
+
+
+if __name__ == '__main__':
+    main()
@@ -44,7 +44,7 @@ for v, q, q_adv, q_str, a, b, idx, v_mask, q_mask, q_mask_adv, image_id, q_id, q
     var_params = {
         'requires_grad': False,
     }
-    v = Variable(v.cuda(), **var_params)
+    v = Variable(data.features_to_cuda(v), **var_params)
     q = Variable(q.cuda(), **var_params)
     a = Variable(a.cuda(), **var_params)
     b = Variable(b.cuda(), **var_params)
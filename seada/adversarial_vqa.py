@@ -13,10 +13,13 @@ import torch.optim.lr_scheduler as lr_scheduler
 from torch.nn.utils import clip_grad_norm_
 import config
 from . import data
+from . import prefetcher
+from . import samplers
 from .attacks import FGSMAttack, IFGSMAttack, RandomNoise, SEA
 if config.model_type == 'baseline':
     from .butd import baseline_model as model
 from . import utils
+from . import vocab
 
 
 class AdversarialAttackVQA:
@@ -59,18 +62,19 @@ class AdversarialAttackVQA:
             self.base_model.module.load_state_dict(logs['weights'])
             if args.attack_only:
                 if self.attack_dict['sea'] is None and 'sea' in self.attack_al:
-                    self.val_loader = data.get_loader(val=True, sea=True)
+                    self.val_loader = data.get_loader(val=True, sea=True, fields=data.MODEL_FIELDS + data.ADV_QUESTION_FIELDS)
                 elif 'sea' in self.attack_al:
+                    # in a distributed run, every process paraphrases its own shard of the questions
                     if self.args.paraphrase_data == 'train':
-                        self.val_loader = data.get_loader(train=True)
+                        self.val_loader = data.get_loader(train=True, fields=data.MODEL_FIELDS + data.SEA_FIELDS, shard=True)
                     elif self.args.paraphrase_data == 'val':
-                        self.val_loader = data.get_loader(val=True)
+                        self.val_loader = data.get_loader(val=True, fields=data.MODEL_FIELDS + data.SEA_FIELDS, shard=True)
                     else:
-                        self.val_loader = data.get_loader(test=True)
+                        self.val_loader = data.get_loader(test=True, fields=data.MODEL_FIELDS + data.SEA_FIELDS, shard=True)
                     self.adversarial.dataset = self.val_loader.dataset
                     self.questions_adv_saver = []
                 else:
-                    self.val_loader = data.get_loader(val=True)
+                    self.val_loader = data.get_loader(val=True, fields=data.MODEL_FIELDS)
             for param in self.base_model.parameters():
                 param.requires_grad = False
             # if not args.advtrain:
@@ -90,25 +94,27 @@ class AdversarialAttackVQA:
             cudnn.benchmark = True
             if args.resume:
                 logs = torch.load(args.resume)
-                # hacky way to tell the VQA classes that they should use the vocab without passing more params around
-                data.preloaded_vocab = logs['vocab']
+                # the VQA datasets built from here on use the vocab of the checkpoint
+                vocab.use(logs['vocab'])
             if args.advtrain_data == 'trainval':
                 if 'sea' in self.attack_al:
-                    self.train_loader = data.get_loader(trainval=True, sea=True, vqacp=self.args.vqacp)
+                    self.train_loader = data.get_loader(trainval=True, sea=True, vqacp=self.args.vqacp,
+                                                        fields=data.MODEL_FIELDS + data.ADV_QUESTION_FIELDS)
                 else:
-                    self.train_loader = data.get_loader(trainval=True, vqacp=self.args.vqacp)
+                    self.train_loader = data.get_loader(trainval=True, vqacp=self.args.vqacp, fields=data.MODEL_FIELDS)
             else:
                 if 'sea' in self.attack_al:
-                    self.train_loader = data.get_loader(train=True, sea=True, frac=args.samples_frac, vqacp=self.args.vqacp)
-                    self.val_loader = data.get_loader(val=True, sea=True, vqacp=self.args.vqacp)
+                    self.train_loader = data.get_loader(train=True, sea=True, frac=args.samples_frac, vqacp=self.args.vqacp,
+                                                        fields=data.MODEL_FIELDS + data.ADV_QUESTION_FIELDS)
+                    self.val_loader = data.get_loader(val=True, sea=True, vqacp=self.args.vqacp,
+                                                      fields=data.MODEL_FIELDS + data.ADV_QUESTION_FIELDS)
                 else:
-                    self.train_loader = data.get_loader(train=True, frac=args.samples_frac, vqacp=self.args.vqacp)
-                    self.val_loader = data.get_loader(val=True, vqacp=self.args.vqacp)
+                    self.train_loader = data.get_loader(train=True, frac=args.samples_frac, vqacp=self.args.vqacp, fields=data.MODEL_FIELDS)
+                    self.val_loader = data.get_loader(val=True, vqacp=self.args.vqacp, fields=data.MODEL_FIELDS)
             if self.attack_dict['sea'] is not None:
                 self.adversarial.dataset = self.train_loader.dataset
-            self.question_keys = self.train_loader.dataset.vocab['question'].keys() if args.advtrain_data == 'trainval' else \
-            self.val_loader.dataset.vocab[
-                'question'].keys()
+            self.question_keys = self.train_loader.dataset.vocab.question.words() if args.advtrain_data == 'trainval' else \
+            self.val_loader.dataset.vocab.question.words()
             self.model = model.Net(self.question_keys)
             self.model = nn.DataParallel(self.model).cuda()
             # if args.resume:
@@ -133,10 +139,11 @@ class AdversarialAttackVQA:
         if args.eval_advtrain or args.test_advtrain:
             if args.checkpoint:
                 logs = torch.load(args.checkpoint)
-                # hacky way to tell the VQA classes that they should use the vocab without passing more params around
-                data.preloaded_vocab = logs['vocab']
-            self.val_loader = data.get_loader(val=True, sea=True if 'sea' in self.attack_al else False) if args.eval_advtrain else data.get_loader(test=True)
-            self.question_keys = self.val_loader.dataset.vocab['question'].keys()
+                # the VQA datasets built from here on use the vocab of the checkpoint
+                vocab.use(logs['vocab'])
+            eval_fields = data.MODEL_FIELDS + (data.ADV_QUESTION_FIELDS if 'sea' in self.attack_al else ())
+            self.val_loader = data.get_loader(val=True, sea=True if 'sea' in self.attack_al else False, fields=eval_fields) if args.eval_advtrain else data.get_loader(test=True, fields=data.MODEL_FIELDS)
+            self.question_keys = self.val_loader.dataset.vocab.question.words()
             self.model = model.Net(self.question_keys)
             self.model = nn.DataParallel(self.model).cuda()
             if args.checkpoint:
@@ -147,7 +154,8 @@ class AdversarialAttackVQA:
 
     def attack(self, loader):
         tracker_class, tracker_params = self.tracker.MeanMonitor, {}
-        loader = tqdm(loader, desc='{} '.format(self.args.attack_al), ncols=0)
+        batches = prefetcher.DevicePrefetcher(loader)
+        loader = tqdm(batches, desc='{} '.format(self.args.attack_al), ncols=0)
         loss_tracker = self.tracker.track('{}_loss'.format('attack'), tracker_class(**tracker_params))
         acc_tracker = self.tracker.track('{}_acc'.format('before attack'), tracker_class(**tracker_params))
         perturbed_acc_tracker = self.tracker.track('{}_acc'.format('after attack'), tracker_class(**tracker_params))
@@ -162,7 +170,7 @@ class AdversarialAttackVQA:
             var_params = {
                 'requires_grad': False,
             }
-            v = v.cuda()
+            v = data.features_to_cuda(v)
             q = Variable(q.cuda())
             a = Variable(a.cuda())
             b = Variable(b.cuda())
@@ -246,8 +254,13 @@ class AdversarialAttackVQA:
             loader.set_postfix(loss=fmt(loss_tracker.mean.value),# acc=fmt(acc_tracker.mean.value),
                                acc_after_attack=fmt(perturbed_acc_tracker.mean.value),
                                distance=fmt(dist_tracker.mean.value))
+        print('attack: {}'.format(batches.summary()))
         if self.args.attack_al == 'sea':
-            with open(config.paraphrase_save_path, 'w') as f:
+            save_path = config.paraphrase_save_path
+            rank, world_size = samplers.distributed_rank()
+            if world_size > 1:
+                save_path = '{}.{}-of-{}'.format(save_path, rank, world_size)
+            with open(save_path, 'w') as f:
                 json.dump({'questions': self.questions_adv_saver}, f)
         if len(self.attack_al) == 1:
             f = open('attack_log.txt', 'a')
@@ -278,7 +291,8 @@ class AdversarialAttackVQA:
                 utils.print_lr(self.optimizer, 'train', epoch)
             else:
                 utils.print_lr(self.optimizer, 'train', epoch)
-            loader = tqdm(self.train_loader, desc='{} E{:03d}'.format('train', epoch), ncols=0)
+            batches = prefetcher.DevicePrefetcher(self.train_loader)
+            loader = tqdm(batches, desc='{} E{:03d}'.format('train', epoch), ncols=0)
             loss_tracker = self.tracker.track('{}_loss'.format('train'), tracker_class(**tracker_params))
             acc_tracker = self.tracker.track('{}_acc'.format('train'), tracker_class(**tracker_params))
 
@@ -286,7 +300,7 @@ class AdversarialAttackVQA:
                 var_params = {
                     'requires_grad': False,
                 }
-                v = Variable(v.cuda(), **var_params)
+                v = Variable(data.features_to_cuda(v), **var_params)
                 q = Variable(q.cuda(), **var_params)
                 a = Variable(a.cuda(), **var_params)
                 b = Variable(b.cuda(), **var_params)
@@ -362,6 +376,7 @@ class AdversarialAttackVQA:
                 acc_tracker.append(acc.data.cpu().mean())
                 fmt = '{:.4f}'.format
                 loader.set_postfix(loss=fmt(loss_tracker.mean.value), acc=fmt(acc_tracker.mean.value))
+            print('train: {}'.format(batches.summary()))
             if self.args.advtrain_data != 'trainval':
                 r = self.evaluate(self.val_loader)
                 if epoch == self.args.adv_delay:
@@ -381,7 +396,7 @@ class AdversarialAttackVQA:
                             'adv_accuracies': r[4],
                             'idx': r[2],
                         },
-                        'vocab': self.val_loader.dataset.vocab if self.args.advtrain_data == 'train' else self.train_loader.dataset.vocab,
+                        'vocab': (self.val_loader.dataset.vocab if self.args.advtrain_data == 'train' else self.train_loader.dataset.vocab).to_json(),
                         'src': self.src,
                         'optimizer': self.optimizer.state_dict(),
                         'scheduler': self.scheduler.state_dict() if config.model_type == 'counting' else [],
@@ -402,7 +417,7 @@ class AdversarialAttackVQA:
                         'adv_accuracies': r[4],
                         'idx': r[2],
                     },
-                    'vocab': self.val_loader.dataset.vocab if self.args.advtrain_data == 'train' else self.train_loader.dataset.vocab,
+                    'vocab': (self.val_loader.dataset.vocab if self.args.advtrain_data == 'train' else self.train_loader.dataset.vocab).to_json(),
                     'src': self.src,
                     'optimizer': self.optimizer.state_dict(),
                     'scheduler': self.scheduler.state_dict() if config.model_type == 'counting' else [],
@@ -423,11 +438,13 @@ class AdversarialAttackVQA:
         # the model at each batch to compute grad, so
         # as not to mess up with the optimization step
         # model_cp = copy.deepcopy(net)
-        model_cp = model.Net(self.question_keys)
-        model_cp = nn.DataParallel(model_cp).cuda()
+        # the snapshot model is built once and only gets the current weights at every batch
+        if getattr(self, 'model_cp', None) is None:
+            self.model_cp = nn.DataParallel(model.Net(self.question_keys)).cuda()
+            for p in self.model_cp.parameters():
+                p.requires_grad = False
+        model_cp = self.model_cp
         model_cp.load_state_dict(net.state_dict())
-        for p in model_cp.parameters():
-            p.requires_grad = False
         # model_cp.eval()
 
         adversary.model = model_cp
@@ -470,7 +487,8 @@ class AdversarialAttackVQA:
         perturbed_accs = []
         if self.args.attacked_checkpoint and self.attack_dict['sea'] is None:
             self.adversarial.model = self.base_model
-        loader = tqdm(loader, desc='{}'.format('val'), ncols=0)
+        batches = prefetcher.DevicePrefetcher(loader)
+        loader = tqdm(batches, desc='{}'.format('val'), ncols=0)
         loss_tracker = self.tracker.track('{}_loss'.format('val'), tracker_class(**tracker_params))
         acc_tracker = self.tracker.track('{}_acc'.format('val'), tracker_class(**tracker_params))
         perturbed_loss_tracker = self.tracker.track('{}_advloss'.format('val'), tracker_class(**tracker_params))
@@ -480,7 +498,7 @@ class AdversarialAttackVQA:
             var_params = {
                 'requires_grad': False,
             }
-            v = Variable(v.cuda(), **var_params)
+            v = Variable(data.features_to_cuda(v), **var_params)
             q = Variable(q.cuda(), **var_params)
             a = Variable(a.cuda(), **var_params)
             b = Variable(b.cuda(), **var_params)
@@ -543,7 +561,8 @@ class AdversarialAttackVQA:
 
             _, clean_answer = clean_out.data.cpu().max(dim=1)
             answ.append(clean_answer.view(-1))
-            idxs.append(idx.view(-1).clone())
+            idxs.append(idx.view(-1).cpu().clone())
+        print('val: {}'.format(batches.summary()))
 
         answ = list(torch.cat(answ, dim=0))
         if has_answers:
@@ -557,11 +576,11 @@ class AdversarialAttackVQA:
 
     def save_result_json(self, loader, has_answers=True):
         r = self.evaluate(loader, has_answers)
-        answer_index_to_string = {a: s for s, a in loader.dataset.answer_to_index.items()}
+        answer_index_to_string = {a: s for s, a in loader.dataset.vocab.answer.to_dict().items()}
         results = []
         for answer, index in zip(r[0], r[2]):
             answer = answer_index_to_string[answer.item()]
-            qid = loader.dataset.question_ids[index]
+            qid = int(loader.dataset.question_ids[index.item()])
             entry = {
                 'question_id': qid,
                 'answer': answer,
@@ -572,8 +591,8 @@ class AdversarialAttackVQA:
 
     def load_checkpoint(self, path):
         logs = torch.load(' '.join(path))
-        # hacky way to tell the VQA classes that they should use the vocab without passing more params around
-        data.preloaded_vocab = logs['vocab']
+        # the VQA datasets built from here on use the vocab of the checkpoint
+        vocab.use(logs['vocab'])
         self.model.module.load_state_dict(logs['weights'])
 
     def distance(self, x, x_adv):
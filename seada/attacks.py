@@ -4,10 +4,9 @@ import config
 from torch.autograd import Variable
 from . import data
 import numpy as np
-import spacy
 
-from .sea.paraphrase_scorer import ParaphraseScorer
-from .sea import onmt_model, replace_rules
+# spacy, onmt and the translation models are only imported by SEA once it is first used,
+# so the other attacks don't pay for them
 
 # --- White-box attacks ---
 inter_feature = {}
@@ -169,16 +168,38 @@ class RandomNoise(object):
         return v_adv, acc.data.cpu(), loss
 
 
+def _fit_width(rows, width, fill):
+    """ Trim or pad [n, length] question rows to `width` tokens """
+    if rows.shape[1] >= width:
+        return rows[:, :width]
+    return torch.cat([rows, rows.new_full((rows.shape[0], width - rows.shape[1]), fill)], dim=1)
+
+
 class SEA(object):
     def __init__(self, dataset=None, model=None, fliprate=0, topk=None):
         self.dataset = dataset
         self.model = model
-        self.ps = ParaphraseScorer(gpu_id=0)
-        self.nlp = spacy.load('en')
+        self._ps = None
+        self._nlp = None
         self.fliprate = fliprate
         #self.ratetemp = fliprate
         self.topk = topk
 
+    @property
+    def ps(self):
+        # loading the translation models takes long, so it waits until the first paraphrase is asked for
+        if self._ps is None:
+            from .sea.paraphrase_scorer import ParaphraseScorer
+            self._ps = ParaphraseScorer(gpu_id=0)
+        return self._ps
+
+    @property
+    def nlp(self):
+        if self._nlp is None:
+            import spacy
+            self._nlp = spacy.load('en')
+        return self._nlp
+
     def perturb(self, X_nat, y=None, oripred=None, epsilon=None, k=None, alpha=None, perturb_q=False, targeted=False):
         v, b, q, q_str, v_mask, q_mask, image_id, q_id, q_len = X_nat
         q_advs = []
@@ -219,9 +240,11 @@ class SEA(object):
         image_id = [image_id[idx] for idx in sort_id]
         q_id = [q_id[idx] for idx in sort_id]
 
-        q_adv = torch.cat(q_advs, dim=0)
+        # paraphrases are encoded to max_question_length, the kept questions only to the width of their batch
+        width = max(int(l) for l in q_len_advs)
+        q_adv = torch.cat([_fit_width(x, width, self.dataset.num_tokens) for x in q_advs], dim=0)
         q_len_adv = torch.cat(q_len_advs, dim=0)
-        q_mask_adv = torch.cat(q_mask_advs, dim=0)
+        q_mask_adv = torch.cat([_fit_width(x, width, 0) for x in q_mask_advs], dim=0)
         v = torch.stack(v, dim=0)
         b = torch.stack(b, dim=0)
         v_mask = torch.stack(v_mask, dim=0)
@@ -229,6 +252,7 @@ class SEA(object):
         return v, b, v_mask, q_adv, q_len_adv, q_mask_adv, y, q_str_advs, image_id, q_id
 
     def find_flips(self, instance, visual=None, topk=1, fliprate=0, threshold=-10, oripred=None):
+        from .sea import onmt_model
         instance_for_onmt = onmt_model.clean_text(' '.join([x.text for x in self.nlp.tokenizer(instance)]), only_upper=False)
         paraphrases = self.ps.generate_paraphrases(instance_for_onmt, topk=topk+1, edit_distance_cutoff=4, threshold=threshold)
         if len(paraphrases) == 0:
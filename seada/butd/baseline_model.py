@@ -54,7 +54,7 @@ class Net(nn.Module):
         answer: predict logits [batch, config.max_answers]
         '''
         q = self.text(q, list(q_len.data), pred_from_emb)  # [batch, 1024]
-        if config.v_feat_norm: 
+        if config.v_feat_norm and not config.v_feat_prenormalized:
             v = v / (v.norm(p=2, dim=2, keepdim=True) + 1e-12).expand_as(v) # [batch, num_obj, 2048]
 
         a = self.attention(v, q) # [batch, 36, num_glimpse]
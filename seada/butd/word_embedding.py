@@ -2,12 +2,11 @@
 Adapted from PyTorch's text library.
 """
 
-import array
+import _pickle as cPickle
+import hashlib
 import os
 import zipfile
 
-import six
-import torch
 from six.moves.urllib.request import urlretrieve
 from tqdm import tqdm
 import numpy as np
@@ -19,6 +18,48 @@ from torch.nn.utils.rnn import pack_padded_sequence
 
 import config
 from config import qa_path
+from ..vocab import TokenMap
+
+
+# init matrices of TextProcessor by hash of the tokens and dim, memory-mapped once per process
+_init_weights = {}
+# hash of the tokens of config.glove_index, the vocab the shipped glove6b_init_{dim}d.npy is built for
+_glove_index_signature = None
+
+
+def _tokens_signature(classes):
+    return hashlib.sha1('\n'.join(classes).encode('utf-8')).hexdigest()
+
+
+def _is_glove_index(signature):
+    global _glove_index_signature
+    if _glove_index_signature is None:
+        with open(config.glove_index, 'rb') as fd:
+            word2idx, idx2word = cPickle.load(fd)
+        _glove_index_signature = _tokens_signature(idx2word)
+    return signature == _glove_index_signature
+
+
+def glove_init_weights(classes, dim):
+    """ GloVe vectors of the question tokens `classes`, in the order of their indices, memory-mapped.
+        The glove6b_init_{dim}d.npy in qa_path belongs to the tokens of config.glove_index, any other vocab gets
+        a file of its own named by a hash of its tokens. Either is built from the word vector store if it isn't there.
+    """
+    signature = _tokens_signature(classes)
+    key = signature, dim
+    if key not in _init_weights:
+        if _is_glove_index(signature):
+            path = os.path.join(qa_path, 'glove6b_init_{}d.npy'.format(dim))
+        else:
+            path = os.path.join(qa_path, 'glove6b_init_{}d-{}.npy'.format(dim, signature[:16]))
+        if not os.path.exists(path):
+            tmp_path = '{}.tmp-{}.npy'.format(path, os.getpid())
+            np.save(tmp_path, obj_edge_vectors(classes, wv_dim=dim).numpy())
+            os.replace(tmp_path, path)
+        # copy-on-write, so that torch.from_numpy doesn't complain about a read-only array
+        _init_weights[key] = np.load(path, mmap_mode='c')
+    return _init_weights[key]
+
 
 class TextProcessor(nn.Module):
     def __init__(self, classes, embedding_features, lstm_features, drop=0.0, use_hidden=True, use_tanh=False, only_embed=False):
@@ -29,7 +70,7 @@ class TextProcessor(nn.Module):
         classes = list(classes)
 
         self.embed = nn.Embedding(len(classes)+1, embedding_features, padding_idx=len(classes))
-        weight_init = torch.from_numpy(np.load(qa_path+'/glove6b_init_300d.npy'))
+        weight_init = torch.from_numpy(np.asarray(glove_init_weights(classes, embedding_features), dtype='float32'))
         assert weight_init.shape == (len(classes), embedding_features)
         # print('glove weight shape: ', weight_init.shape)
         self.embed.weight.data[:len(classes)] = weight_init
@@ -74,27 +115,21 @@ class TextProcessor(nn.Module):
 #embed_vecs = obj_edge_vectors(classes, wv_dim=embedding_features)
 #self.embed.weight.data = embed_vecs.clone()
 def obj_edge_vectors(names, wv_type='glove.6B', wv_dir=qa_path, wv_dim=300):
-    wv_dict, wv_arr, wv_size = load_word_vectors(wv_dir, wv_type, wv_dim)
+    wv = load_word_vectors(wv_dir, wv_type, wv_dim)
 
+    names = list(names)
     vectors = torch.Tensor(len(names), wv_dim)
     vectors.normal_(0,1)
-    failed_token = []
-    for i, token in enumerate(names):
-        wv_index = wv_dict.get(token, None)
-        if wv_index is not None:
-            vectors[i] = wv_arr[wv_index]
-        else:
-            # Try the longest word (hopefully won't be a preposition
-            lw_token = sorted(token.split(' '), key=lambda x: len(x), reverse=True)[0]
-            #print("{} -> {} ".format(token, lw_token))
-            wv_index = wv_dict.get(lw_token, None)
-            if wv_index is not None:
-                vectors[i] = wv_arr[wv_index]
-            else:
-                failed_token.append(token)
-    if (len(failed_token) > 0):
-        print('Num of failed tokens: ', len(failed_token))
-        #print(failed_token)
+    rows = wv.index.encode(names)
+    missing = np.flatnonzero(rows < 0)
+    # Try the longest word (hopefully won't be a preposition
+    rows[missing] = wv.index.encode([max(names[i].split(' '), key=len) for i in missing])
+    found = np.flatnonzero(rows >= 0)
+    # only the rows of the names are read from the mapping
+    vectors[torch.from_numpy(found)] = torch.from_numpy(np.asarray(wv.vectors[rows[found]], dtype='float32'))
+    num_failed = len(names) - len(found)
+    if num_failed > 0:
+        print('Num of failed tokens: ', num_failed)
     return vectors
 
 URL = {
@@ -105,19 +140,47 @@ URL = {
         }
 
 
+class WordVectors:
+    """ Word vectors stored as a float32 [num_words, dim] .npy that is memory-mapped, plus a TokenMap
+        (sorted words and their rows) as the index of the words
+    """
+    def __init__(self, fname):
+        self.vectors = np.load(fname + '.vectors.npy', mmap_mode='r')
+        self.index = TokenMap(np.load(fname + '.words.npy', mmap_mode='r'), np.load(fname + '.rows.npy', mmap_mode='r'))
+        self.dim = self.vectors.shape[1]
+
+
+def convert_word_vectors(fname_txt, fname):
+    """ Parse a GloVe text file once into the files of WordVectors """
+    wv_tokens, wv_rows = [], []
+    with open(fname_txt, 'rb') as fd:
+        for line in tqdm(fd, desc="converting word vectors from {}".format(fname_txt)):
+            word, _, entries = line.rstrip().partition(b' ')
+            try:
+                word = word.decode('utf-8')
+            except UnicodeDecodeError:
+                print('non-UTF8 token', repr(word), 'ignored')
+                continue
+            wv_rows.append(np.array(entries.split(b' '), dtype='float32'))
+            wv_tokens.append(word)
+    index = TokenMap.from_dict({word: i for i, word in enumerate(wv_tokens)})
+    # written under temporary names and renamed, the vectors last, since their presence marks a complete store
+    for suffix, array in (('.words.npy', index.tokens), ('.rows.npy', index.indices), ('.vectors.npy', np.stack(wv_rows))):
+        tmp_path = '{}.tmp-{}{}'.format(fname, os.getpid(), suffix)
+        np.save(tmp_path, array)
+        os.replace(tmp_path, fname + suffix)
+
+
 def load_word_vectors(root, wv_type, dim):
-    """Load word vectors from a path, trying .pt, .txt, and .zip extensions."""
+    """Load word vectors from a path, converting .txt (or a downloaded .zip) once into the memory-mapped WordVectors."""
     if isinstance(dim, int):
         dim = str(dim) + 'd'
     fname = os.path.join(root, wv_type + '.' + dim)
-    if os.path.isfile(fname + '.pt'):
-        fname_pt = fname + '.pt'
-        print('loading word vectors from', fname_pt)
-        return torch.load(fname_pt)
+    if os.path.isfile(fname + '.vectors.npy'):
+        return WordVectors(fname)
     if os.path.isfile(fname + '.txt'):
-        fname_txt = fname + '.txt'
-        cm = open(fname_txt, 'rb')
-        cm = [line for line in cm]
+        convert_word_vectors(fname + '.txt', fname)
+        return WordVectors(fname)
     elif os.path.basename(wv_type) in URL:
         url = URL[wv_type]
         print('downloading word vectors from {}'.format(url))
@@ -135,28 +198,6 @@ def load_word_vectors(root, wv_type, dim):
     else:
         raise RuntimeError('unable to load word vectors')
 
-    wv_tokens, wv_arr, wv_size = [], array.array('d'), None
-    if cm is not None:
-        for line in tqdm(range(len(cm)), desc="loading word vectors from {}".format(fname_txt)):
-            entries = cm[line].strip().split(b' ')
-            word, entries = entries[0], entries[1:]
-            if wv_size is None:
-                wv_size = len(entries)
-            try:
-                if isinstance(word, six.binary_type):
-                    word = word.decode('utf-8')
-            except:
-                print('non-UTF8 token', repr(word), 'ignored')
-                continue
-            wv_arr.extend(float(x) for x in entries)
-            wv_tokens.append(word)
-
-    wv_dict = {word: i for i, word in enumerate(wv_tokens)}
-    wv_arr = torch.Tensor(wv_arr).view(-1, wv_size)
-    ret = (wv_dict, wv_arr, wv_size)
-    torch.save(ret, fname + '.pt')
-    return ret
-
 def reporthook(t):
     """https://github.com/tqdm/tqdm"""
     last_b = [0]
@@ -1,93 +1,258 @@
+import collections
+import inspect
+import itertools
 import json
 import os
 import os.path
 import re
 
-import _pickle as cPickle
-from PIL import Image
-import h5py
 import torch
 import torch.utils.data as data
-import torchvision.transforms as transforms
 import numpy as np
 
 import config
+from . import features
+from . import qa_cache
+from . import ring_loader
+from . import samplers
+from . import shards
 from . import utils
-
-
-preloaded_vocab = None
-
-
-def get_loader(train=False, val=False, test=False, trainval=False, sea=False, frac=1, iq=False, vqacp=False):
-    """ Returns a data loader for the desired split """
+from . import vocab
+
+
+# names of the fields of every batch, in the order of the tuple a loader yields
+FIELDS = ('v', 'q', 'q_adv', 'q_str', 'a', 'b', 'idx', 'v_mask', 'q_mask', 'q_adv_mask', 'image_id', 'q_id', 'q_adv_len', 'q_len')
+# fields every training and evaluation loop feeds to the model
+MODEL_FIELDS = ('v', 'q', 'a', 'b', 'idx', 'v_mask', 'q_mask', 'q_len')
+# paraphrased questions of the sea question files
+ADV_QUESTION_FIELDS = ('q_adv', 'q_adv_mask', 'q_adv_len')
+# what SEA needs to generate and save paraphrases
+SEA_FIELDS = ('q_str', 'image_id', 'q_id')
+
+
+def get_loader(train=False, val=False, test=False, trainval=False, sea=False, frac=1, iq=False, vqacp=False, fields=None, shard=False):
+    """ Returns a data loader for the desired split.
+        Only the `fields` (see FIELDS, all by default) are built, the others are None in the batches.
+        In a distributed run, a `shard`ed loader only yields this process's share of the batches (every process still builds the whole split).
+        Only paraphrase generation shards its loaders, training isn't distributed (no DistributedDataParallel), so its loaders aren't either.
+    """
+    questions_path, answers_path, questions_adv_path = qa_paths_for(train=train, val=val, test=test, trainval=trainval, sea=sea, iq=iq, vqacp=vqacp)
     split = VQA(
-        utils.path_for(train=train, val=val, test=test, trainval=trainval, question=True, iq=iq, vqacp=vqacp),
-        utils.path_for(train=train, val=val, test=test, trainval=trainval, answer=True, iq=iq, vqacp=vqacp),
-        config.preprocessed_trainval_path if not test else config.preprocessed_test_path,
-        utils.path_for(train=train, val=val, test=test, trainval=trainval, question=True, sea=sea, iq=iq),
+        questions_path,
+        answers_path,
+        utils.features_paths_for(test=test),
+        questions_adv_path,
         answerable_only=train or trainval,
         frac=frac,
         dummy_answers=test,
+        fields=fields,
     )
-    loader = torch.utils.data.DataLoader(
+    batch_size = 64 if config.model_type == 'ban' and val else config.batch_size
+    if config.batch_source == 'shards' and (train or trainval) and not vqacp:
+        # training batches are streamed from the shards of the split
+        shard_dir = shards.shards_dir_for('trainval' if trainval else 'train')
+        stream = shards.ShardStream(split, shard_dir, batch_size, buffer_images=config.shard_shuffle_images, seed=config.seed, shard=shard)
+        return shards.ShardLoader(stream, collate_fn=batched_collate_fn, **_worker_options())
+    return make_loader(split, batch_size, shuffle=train or trainval, shard=shard)  # only shuffle the data in training
+
+
+def make_loader(split, batch_size, shuffle=False, shard=False):
+    """ Data loader over a VQA split that fetches whole batches, grouped as chosen by config.batch_sampler """
+    if config.batch_sampler == 'image':
+        batch_sampler = samplers.ImageGroupedBatchSampler(
+            split.image_ids(),
+            batch_size,
+            max_per_image=config.max_questions_per_image,
+            shuffle=shuffle,
+            seed=config.seed,
+        )
+    elif config.batch_sampler == 'length':
+        batch_sampler = samplers.LengthBucketedBatchSampler(
+            split.item_lengths(),
+            batch_size,
+            shuffle=shuffle,
+            bucket_batches=config.length_bucket_batches,
+            seed=config.seed,
+        )
+    else:
+        batch_sampler = samplers.ShuffledBatchSampler(len(split), batch_size, shuffle=shuffle, seed=config.seed)
+    rank, world_size = samplers.distributed_rank()
+    if shard and world_size > 1:
+        batch_sampler = samplers.ShardedBatchSampler(batch_sampler, rank, world_size)
+    if config.batch_transport == 'ring':
+        return ring_loader.RingBufferLoader(
+            split,
+            batch_sampler,
+            num_workers=config.data_workers,
+            num_slots=config.ring_buffer_slots,
+            slot_bytes=ring_loader.slot_bytes_for(split, batch_size),
+        )
+    # the sampler yields whole batches, which VQA builds itself one field at a time
+    return torch.utils.data.DataLoader(
         split,
-        batch_size=64 if config.model_type == 'ban' and val else config.batch_size,
-        shuffle=train or trainval,  # only shuffle the data in training
-        pin_memory=True,
-        num_workers=config.data_workers,
-        collate_fn=collate_fn,
+        sampler=batch_sampler,
+        batch_size=None,
+        collate_fn=batched_collate_fn,
+        **_worker_options()
+    )
+
+
+def _worker_options():
+    options = {'pin_memory': True, 'num_workers': config.data_workers}
+    # persistent workers are kept alive between epochs instead of forking the whole process again (torch >= 1.7)
+    if config.persistent_workers and config.data_workers > 0 and \
+            'persistent_workers' in inspect.signature(torch.utils.data.DataLoader.__init__).parameters:
+        options['persistent_workers'] = True
+    return options
+
+
+def _zeros(shape, dtype, allocate=None):
+    """ Zero-filled tensor, carved out of the caller's buffer by `allocate` if there is one (see ring_loader) """
+    if allocate is None:
+        return torch.zeros(shape, dtype=dtype)
+    return allocate(shape, dtype).zero_()
+
+
+def _pad_objects(tensors, max_objs, dtype=None, allocate=None, order=None):
+    """ Stack per-image tensors into one batch tensor padded to `max_objs` rows, filling it in the given `order` """
+    if isinstance(tensors[0], features.QuantizedFeatures):
+        return features.QuantizedFeatures(*(_pad_objects(part, max_objs, allocate=allocate, order=order) for part in zip(*tensors)))
+    padded = _zeros((len(tensors), max_objs) + tuple(tensors[0].shape[1:]), dtype or tensors[0].dtype, allocate)
+    for i in (order if order is not None else range(len(tensors))):
+        padded[i, :tensors[i].shape[0]] = tensors[i]
+    return padded
+
+
+def _questions_batch(questions, lengths, items):
+    """ Token rows of `items`, trimmed to the longest of them, and their masks """
+    width = max(int(lengths.max()), 1)
+    q = torch.from_numpy(np.ascontiguousarray(questions[items, :width]))
+    q_mask = torch.from_numpy((np.arange(width) < lengths[:, None]).astype('float32'))
+    return q, q_mask
+
+
+def _answers_batch(indices, counts, offsets, items, num_answers, allocate=None):
+    """ Dense answer vectors of `items` from the (index, count) pairs of every question """
+    # answer vec will be a vector of answer counts to determine which answers will contribute to the loss.
+    # this should be multiplied with 0.1 * negative log-likelihoods that a model produces and then summed up
+    # to get the loss that is weighted by how many humans gave that answer
+    starts = offsets[items]
+    num_pairs = offsets[items + 1] - starts
+    rows = np.repeat(np.arange(len(items)), num_pairs)
+    # position of every pair in indices/counts: the start of its question there plus its rank among that question's pairs
+    pairs = np.arange(num_pairs.sum()) + np.repeat(starts - (np.cumsum(num_pairs) - num_pairs), num_pairs)
+    answers = _zeros((len(items), num_answers), torch.float32, allocate)
+    answers[torch.from_numpy(rows), torch.from_numpy(indices[pairs])] = torch.from_numpy(counts[pairs])
+    return answers
+
+
+def features_to_cuda(v):
+    """ Move a batch of visual features to the gpu, dequantizing them there if they come from a reduced-precision store """
+    if isinstance(v, features.QuantizedFeatures):
+        v = features.QuantizedFeatures(v.values.cuda(), v.scales.cuda())
+    else:
+        v = v.cuda()
+    return features.dequantize(v)
+
+
+def qa_paths_for(train=False, val=False, test=False, trainval=False, sea=False, iq=False, vqacp=False):
+    """ Paths of the questions, answers and paraphrased (`sea`) questions of a split, as passed to VQA.
+        trainval is not a file of its own but the train and val jsons, which VQA concatenates on top of their qa caches.
+    """
+    if trainval and not vqacp:
+        parts = [{'train': True}, {'val': True}]
+        return (
+            [utils.path_for(question=True, iq=iq, **part) for part in parts],
+            [utils.path_for(answer=True, iq=iq, **part) for part in parts],
+            [utils.path_for(question=True, sea=sea, iq=iq, **part) for part in parts],
+        )
+    return (
+        utils.path_for(train=train, val=val, test=test, trainval=trainval, question=True, iq=iq, vqacp=vqacp),
+        utils.path_for(train=train, val=val, test=test, trainval=trainval, answer=True, iq=iq, vqacp=vqacp),
+        utils.path_for(train=train, val=val, test=test, trainval=trainval, question=True, sea=sea, iq=iq),
     )
-    return loader
 
 
-def collate_fn(batch):
-    # put question lengths in descending order so that we can use packed sequences later
-    batch.sort(key=lambda x: x[-1], reverse=True)
-    return data.dataloader.default_collate(batch)
+def batched_collate_fn(batch):
+    # batches fetched as a whole are already collated by VQA
+    return batch
+
+
+def _concat_qa(parts, fill):
+    """ The qa arrays of several splits as those of one: questions are padded with `fill` to the longest part
+        and the offsets into the answers and question strings are shifted past the parts before them
+    """
+    qa = {}
+    for name in ('questions', 'questions_adv'):
+        if name in parts[0]:
+            width = max(part[name].shape[1] for part in parts)
+            qa[name] = np.concatenate([np.pad(part[name], ((0, 0), (0, width - part[name].shape[1])), mode='constant', constant_values=fill)
+                                       for part in parts])
+    for name in ('question_lengths', 'questions_adv_lengths', 'answer_indices', 'answer_counts', 'question_ids', 'image_ids', 'question_str'):
+        if name in parts[0]:
+            qa[name] = np.concatenate([part[name] for part in parts])
+    for name, values in (('answer_offsets', 'answer_indices'), ('question_str_offsets', 'question_str')):
+        starts = np.cumsum([0] + [len(part[values]) for part in parts])
+        qa[name] = np.concatenate([parts[0][name][:1]] + [part[name][1:] + start for part, start in zip(parts, starts)])
+    return qa
 
 
 class VQA(data.Dataset):
     """ VQA dataset, open-ended """
-    def __init__(self, questions_path, answers_path, image_features_path, questions_adv_path=None, answerable_only=False, frac=1, dummy_answers=False):
+    def __init__(self, questions_path, answers_path, image_features_path, questions_adv_path=None, answerable_only=False, frac=1, dummy_answers=False, fields=None):
         super(VQA, self).__init__()
-        with open(questions_path, 'r') as fd:
-            questions_json = json.load(fd)
-        with open(answers_path, 'r') as fd:
-            answers_json = json.load(fd)
-        if 'adv' in questions_adv_path:
-            with open(questions_adv_path, 'r') as fd:
-                questions_adv_json = json.load(fd)
-        if preloaded_vocab:
-            vocab_json = preloaded_vocab
+        # fields built for every batch, see FIELDS
+        self.fields = set(fields or FIELDS)
+        # set by ring_loader workers to build the large tensors of a batch straight into shared memory
+        self.allocate = None
+        # vocab, compiled and memory-mapped once per process and shared by all datasets (see vocab.use for checkpoints)
+        self.vocab = vocab.get()
+
+        # q and a, parsed and encoded once and then memory-mapped from the cache by every later run
+        # lists of paths make a virtual split (trainval: train and val), concatenated in memory from the caches of its parts
+        # at load time and never stored itself
+        combined = isinstance(questions_path, (list, tuple))
+        if not combined:
+            questions_path, answers_path, questions_adv_path = [questions_path], [answers_path], [questions_adv_path]
+        # paraphrases are only used if every part has them
+        with_adv = questions_adv_path is not None and all(path is not None and 'adv' in path for path in questions_adv_path)
+        if not with_adv:
+            questions_adv_path = [None] * len(questions_path)
+        parts = list(zip(questions_path, answers_path, questions_adv_path))
+        keys = [qa_cache.cache_key([path for path in part if path is not None], self.vocab) for part in parts]
+        if combined:
+            qa = _concat_qa([self._load_qa(part_key, *part) for part_key, part in zip(keys, parts)], fill=self.num_tokens)
         else:
-            with open(config.vocabulary_path, 'r') as fd:
-                vocab_json = json.load(fd)
-            word2idx, idx2word = cPickle.load(open(config.glove_index, 'rb'))
-            vocab_json['question'] = word2idx
-
-        self.question_ids = [q['question_id'] for q in questions_json['questions']]
-
-        # vocab
-        self.vocab = vocab_json
-        self.token_to_index = self.vocab['question']
-        self.answer_to_index = self.vocab['answer']
-
-        # q and a
-        self.q_id = [q['question_id'] for q in questions_json['questions']]
-        self.question_str = [q['question'] for q in questions_json['questions']]   # for sea
-        self.questions = list(prepare_questions(questions_json, self.q_id))
+            qa = self._load_qa(keys[0], *parts[0])
+        # everything is kept in a few flat arrays rather than lists of python objects, so that data workers
+        # share the pages instead of copying them when reference counts are touched
+        self._max_length = qa['questions'].shape[1]
+        self.q_id = qa['question_ids']
+        self.question_ids = self.q_id
+        self.question_str = qa['question_str']   # for sea, utf-8 bytes of all questions, split by question_str_offsets
+        self.question_str_offsets = qa['question_str_offsets']
+        self.questions = qa['questions']
+        self.question_lengths = qa['question_lengths']
         self.questions_adv = None
-        if 'adv' in questions_adv_path:
-            self.questions_adv = list(prepare_questions(questions_adv_json, self.q_id))
-            self.questions_adv = [self.encode_question(q) for q in self.questions_adv]
-        self.answers = list(prepare_answers(answers_json, self.q_id))
-        self.questions = [self.encode_question(q) for q in self.questions]
-        self.answers = [self._encode_answers(a) for a in self.answers]
+        if with_adv:
+            self.questions_adv = qa['questions_adv']
+            self.questions_adv_lengths = qa['questions_adv_lengths']
+        self.answer_indices = qa['answer_indices']
+        self.answer_counts = qa['answer_counts']
+        self.answer_offsets = qa['answer_offsets']
 
         # v
         self.image_features_path = image_features_path
-        self.coco_id_to_index = self._create_coco_id_to_index()
-        self.coco_ids = [q['image_id'] for q in questions_json['questions']]
+        # loaders of the same store share one open instance of it
+        self.features = features.open_shared(image_features_path)
+        if self.features.normalized_features != config.v_feat_prenormalized:
+            raise RuntimeError('{} {} L2-normalized features, set config.v_feat_prenormalized accordingly'.format(
+                image_features_path, 'has' if self.features.normalized_features else 'does not have'))
+        self.feature_cache = None
+        if config.feature_cache_bytes and not self.features.in_memory and not self.features.memory_mapped:
+            self.feature_cache = features.FeatureCache(config.feature_cache_bytes)
+        self.id_index = self.features.id_index()
+        self.coco_ids = qa['image_ids']
 
         self.dummy_answers= dummy_answers
 
@@ -96,24 +261,45 @@ class VQA(data.Dataset):
         if self.answerable_only:
             self.answerable = self._find_answerable(not self.answerable_only)
             self.answerable = self.answerable[:int(len(self.answerable) * frac)]
-            
+
+    def _load_qa(self, key, questions_path, answers_path, questions_adv_path=None):
+        """ The qa arrays of one split from the qa cache, prepared and cached under `key` first if they aren't there """
+        qa = qa_cache.load(key)
+        if qa is None:
+            qa = self._prepare_qa(questions_path, answers_path, questions_adv_path)
+            qa_cache.save(key, qa)
+        return qa
+
+    def _prepare_qa(self, questions_path, answers_path, questions_adv_path=None):
+        """ Parse, normalize and encode the question and answer jsons into the arrays kept in the qa cache """
+        with open(questions_path, 'r') as fd:
+            questions_json = json.load(fd)
+        with open(answers_path, 'r') as fd:
+            answers_json = json.load(fd)
+        q_id = [q['question_id'] for q in questions_json['questions']]
+        questions = list(prepare_questions(questions_json, q_id))
+        self._max_length = min(config.max_q_length, max(map(len, questions)))
+
+        qa = {}
+        qa['questions'], qa['question_lengths'] = self._encode_questions(questions)
+        if questions_adv_path is not None:
+            with open(questions_adv_path, 'r') as fd:
+                questions_adv_json = json.load(fd)
+            qa['questions_adv'], qa['questions_adv_lengths'] = self._encode_questions(prepare_questions(questions_adv_json, q_id))
+        qa['answer_indices'], qa['answer_counts'], qa['answer_offsets'] = self._encode_answers(prepare_answers(answers_json, q_id))
+        qa['question_ids'] = np.array(q_id, dtype='int64')
+        qa['image_ids'] = np.array([q['image_id'] for q in questions_json['questions']], dtype='int64')
+        qa['question_str'], qa['question_str_offsets'] = qa_cache.encode_strings(q['question'] for q in questions_json['questions'])
+        return qa
+
     @property
     def max_question_length(self):
-        if not hasattr(self, '_max_length'):
-            data_max_length = max(map(len, self.questions))
-            self._max_length = min(config.max_q_length, data_max_length)
+        # min(config.max_q_length, longest question), set when the questions are encoded or loaded from the qa cache
         return self._max_length
 
     @property
     def num_tokens(self):
-        return len(self.token_to_index)
-
-    def _create_coco_id_to_index(self):
-        """ Create a mapping from a COCO image id into the corresponding index into the h5 file """
-        with h5py.File(self.image_features_path, 'r') as features_file:
-            coco_ids = features_file['ids'][()]
-        coco_id_to_index = {id: i for i, id in enumerate(coco_ids)}
-        return coco_id_to_index
+        return len(self.vocab.question)
 
     def _check_integrity(self, questions, answers):
         """ Verify that we are using the correct data """
@@ -125,86 +311,147 @@ class VQA(data.Dataset):
 
     def _find_answerable(self, count=False):
         """ Create a list of indices into questions that will have at least one answer that is in the vocab """
-        answerable = []
+        num_answers = np.diff(self.answer_offsets)
         if count:
-            number_indices = torch.LongTensor([self.answer_to_index[str(i)] for i in range(0, 8)])
-        for i, answers in enumerate(self.answers):
-            # store the indices of anything that is answerable
-            if count:
-                answers = answers[number_indices]
-            answer_has_index = len(answers.nonzero()) > 0
-            if answer_has_index:
-                answerable.append(i)
-        return answerable
+            number_indices = self.vocab.answer.encode([str(i) for i in range(0, 8)])
+            is_number = np.isin(self.answer_indices, number_indices)
+            question_of_answer = np.repeat(np.arange(len(num_answers)), num_answers)
+            num_answers = np.bincount(question_of_answer, weights=is_number, minlength=len(num_answers))
+        # only answers in the vocab are stored, so anything with a stored answer is answerable
+        return np.flatnonzero(num_answers > 0)
 
     def encode_question(self, question):
         """ Turn a question into a vector of indices and a question length """
         vec = torch.zeros(self.max_question_length).long().fill_(self.num_tokens)
-        for i, token in enumerate(question):
-            if i >= self.max_question_length:
-                break
-            index = self.token_to_index.get(token, self.num_tokens - 1)
-            vec[i] = index
-        return vec, min(len(question), self.max_question_length)
+        question = question[:self.max_question_length]
+        vec[:len(question)] = torch.from_numpy(self.vocab.question.encode(question, unknown=self.num_tokens - 1))
+        return vec, len(question)
+
+    def _encode_questions(self, questions):
+        """ Turn tokenized questions into a [num_questions, max_question_length] matrix of indices and their lengths """
+        questions = [question[:self.max_question_length] for question in questions]
+        lengths = np.array([len(question) for question in questions], dtype='int64')
+        vecs = np.full((len(questions), self.max_question_length), self.num_tokens, dtype='int64')
+        # all tokens are looked up at once, and land row by row in the positions before every question's length
+        tokens = self.vocab.question.encode(list(itertools.chain.from_iterable(questions)), unknown=self.num_tokens - 1)
+        vecs[np.arange(self.max_question_length) < lengths[:, None]] = tokens
+        return vecs, lengths
 
     def _encode_answers(self, answers):
-        """ Turn an answer into a vector """
-        # answer vec will be a vector of answer counts to determine which answers will contribute to the loss.
-        # this should be multiplied with 0.1 * negative log-likelihoods that a model produces and then summed up
-        # to get the loss that is weighted by how many humans gave that answer
-        answer_vec = torch.zeros(len(self.answer_to_index))
-        for answer in answers:
-            index = self.answer_to_index.get(answer)
-            if index is not None:
-                answer_vec[index] += 1
-        return answer_vec
-
-    def _load_image(self, image_id):
-        """ Load an image """
-        if not hasattr(self, 'features_file'):
-            # Loading the h5 file has to be done here and not in __init__ because when the DataLoader
-            # forks for multiple works, every child would use the same file object and fail
-            # Having multiple readers using different file objects is fine though, so we just init in here.
-            self.features_file = h5py.File(self.image_features_path, 'r')
-        index = self.coco_id_to_index[image_id]
-        img = self.features_file['features'][index]
-        boxes = self.features_file['boxes'][index]
-        widths = self.features_file['widths'][index]
-        heights = self.features_file['heights'][index]
-        obj_mask = (img.sum(0) > 0).astype(int)
-        return torch.from_numpy(img).transpose(0,1), torch.from_numpy(boxes).transpose(0,1), torch.from_numpy(obj_mask), widths, heights
+        """ Turn the answers of every question into (index, count) pairs of the answers that are in the vocab,
+            concatenated over all questions with an offsets array
+        """
+        answers = list(answers)
+        num_answers = np.array([len(answer_list) for answer_list in answers], dtype='int64')
+        indices = self.vocab.answer.encode(list(itertools.chain.from_iterable(answers)))
+        questions = np.repeat(np.arange(len(answers)), num_answers)
+        known = indices >= 0
+        # every distinct (question, answer) pair with how often it was given, ordered by question
+        pairs, counts = np.unique(questions[known] * len(self.vocab.answer) + indices[known], return_counts=True)
+        offsets = np.searchsorted(pairs // len(self.vocab.answer), np.arange(len(answers) + 1))
+        return pairs % len(self.vocab.answer), counts.astype('float32'), offsets.astype('int64')
+
+    def _load_images(self, image_ids):
+        """ Load the images with the (distinct) `image_ids`, as a dict from image id to image """
+        images = {}
+        missing = []
+        for image_id in image_ids:
+            image = self.feature_cache.get(image_id) if self.feature_cache is not None else None
+            if image is not None:
+                images[image_id] = image
+            else:
+                missing.append(image_id)
+        indices = self.id_index.rows_of(missing).tolist()
+        if config.sort_batch_reads or isinstance(self.features, features.StripedFeatures):
+            # read in storage order, adjacent rows at once, instead of one scattered read per image
+            # (a striped store also reads all of its stripes in parallel then)
+            loaded = self.features.load_many(indices)
+        else:
+            loaded = [self.features.load(index) for index in indices]
+        for image_id, (v, b, obj_mask, width, height) in zip(missing, loaded):
+            # stores built with --normalize_boxes already hold normalized boxes
+            b = features.rescale_boxes(b, width, height, self.features.normalized_boxes)
+            image = v, b, obj_mask, width, height
+            if self.feature_cache is not None:
+                self.feature_cache.put(image_id, image)
+            images[image_id] = image
+        return images
+
+    def image_ids(self):
+        """ COCO image id of every question, in the order of the dataset's indices """
+        coco_ids = self.coco_ids
+        if self.answerable_only:
+            coco_ids = coco_ids[self.answerable]
+        return coco_ids
 
-    def __getitem__(self, item):
+    def item_lengths(self):
+        """ Question length of every question, in the order of the dataset's indices """
+        lengths = self.question_lengths
+        if self.answerable_only:
+            lengths = lengths[self.answerable]
+        return lengths
+
+    def __getitem__(self, items):
+        """ Build the batch of questions at the positions `items` (a single position gives a batch of one) """
+        if not isinstance(items, list):
+            items = [items]
+        return self._get_batch(items)
+
+    def _get_batch(self, items, images=None):
+        """ Build a whole batch at once, one array per field, reading the features of every image in it only once.
+            The batch is a tuple in the order of FIELDS, with None for the fields that are not in self.fields.
+            `images` holds images that were already loaded (see shards.ShardStream), by image id.
+        """
+        items = np.array(items, dtype='int64')
         if self.answerable_only:
-            item = self.answerable[item]
-        q, q_length = self.questions[item]
-        q_adv = 0
-        q_adv_mask = 0
-        q_adv_length = 0
+            items = self.answerable[items]
+        # put question lengths in descending order so that we can use packed sequences later
+        items = items[np.argsort(-self.question_lengths[items], kind='stable')]
+        fields = self.fields
+        batch = {}
+        q_len = np.asarray(self.question_lengths[items])
+        if 'q' in fields or 'q_mask' in fields:
+            batch['q'], batch['q_mask'] = _questions_batch(self.questions, q_len, items)
+        batch['q_len'] = torch.from_numpy(q_len)
         if self.questions_adv is not None:
-            q_adv, q_adv_length = self.questions_adv[item]
-            q_adv_mask = torch.from_numpy((np.arange(self.max_question_length) < q_adv_length).astype(int)).float()
-        q_str = self.question_str[item]
-        q_mask = torch.from_numpy((np.arange(self.max_question_length) < q_length).astype(int))
-        if not self.dummy_answers:
-            a = self.answers[item]
+            q_adv_len = np.asarray(self.questions_adv_lengths[items])
+            if 'q_adv' in fields or 'q_adv_mask' in fields:
+                batch['q_adv'], batch['q_adv_mask'] = _questions_batch(self.questions_adv, q_adv_len, items)
+            batch['q_adv_len'] = torch.from_numpy(q_adv_len)
         else:
-            # just return a dummy answer, it's not going to be used anyway
-            a = 0
-        image_id = self.coco_ids[item]
-        q_id = self.q_id[item]
-        v, b, obj_mask, width, height = self._load_image(image_id)
+            batch['q_adv'] = batch['q_adv_mask'] = batch['q_adv_len'] = torch.zeros(len(items)).long()
+        if 'q_str' in fields:
+            offsets = self.question_str_offsets
+            batch['q_str'] = [self.question_str[offsets[item]:offsets[item + 1]].tobytes().decode('utf-8') for item in items]   # for sea
+        if 'a' in fields:
+            if not self.dummy_answers:
+                batch['a'] = _answers_batch(self.answer_indices, self.answer_counts, self.answer_offsets, items,
+                                            len(self.vocab.answer), self.allocate)
+            else:
+                # just return a dummy answer, it's not going to be used anyway
+                batch['a'] = torch.zeros(len(items)).long()
+        image_ids = np.asarray(self.coco_ids[items])
+        if fields & {'v', 'b', 'v_mask'}:
+            preloaded = images is not None
+            if not preloaded:
+                images = self._load_images(list(collections.OrderedDict.fromkeys(image_ids.tolist())))
+            v, b, obj_mask, width, height = zip(*(images[image_id] for image_id in image_ids.tolist()))
+            # images from a ragged feature store only have their real boxes, pad them once straight into the batch tensors
+            max_objs = config.output_size if config.pad_objects == 'fixed' else max(len(boxes) for boxes in b)
+            order = None
+            if config.sort_batch_reads and not preloaded:
+                # features of a memory-mapped store are only read when they are copied into the batch
+                order = np.argsort(self.id_index.rows_of(image_ids), kind='stable')
+            batch['v'] = _pad_objects(v, max_objs, allocate=self.allocate, order=order)
+            batch['b'] = _pad_objects(b, max_objs, allocate=self.allocate)
+            batch['v_mask'] = _pad_objects(obj_mask, max_objs, torch.float32, self.allocate)
         # since batches are re-ordered for PackedSequence's, the original question order is lost
-        # we return `item` so that the order of (v, q, a) triples can be restored if desired
+        # we return `idx` so that the order of (v, q, a) triples can be restored if desired
         # without shuffling in the dataloader, these will be in the order that they appear in the q and a json's.
-        if config.normalize_box:
-            assert b.shape[1] == 4
-            b[:, 0] = b[:, 0] / float(width)
-            b[:, 1] = b[:, 1] / float(height)
-            b[:, 2] = b[:, 2] / float(width)
-            b[:, 3] = b[:, 3] / float(height)
-        
-        return v, q, q_adv, q_str, a, b, item, obj_mask.float(), q_mask.float(), q_adv_mask, image_id, q_id, q_adv_length, q_length
+        batch['idx'] = torch.from_numpy(items)
+        batch['image_id'] = torch.from_numpy(image_ids)
+        batch['q_id'] = torch.from_numpy(np.asarray(self.q_id[items]))
+        return tuple(batch[name] if name in fields else None for name in FIELDS)
 
     def __len__(self):
         if self.answerable_only:
@@ -224,6 +471,13 @@ _punctuation = re.compile(r'([{}])'.format(re.escape(_punctuation_chars)))
 _punctuation_with_a_space = re.compile(r'(?<= )([{0}])|([{0}])(?= )'.format(_punctuation_chars))
 
 
+def tokenize_question(question):
+    """ Tokenize and normalize a single question """
+    question = question.lower()[:-1]
+    question = _special_chars.sub('', question)
+    return question.split(' ')
+
+
 def prepare_questions(questions_json, q_id):
     """ Tokenize and normalize questions from a given question json in the usual VQA format. """
     questions = [q['question'] for q in questions_json['questions']]
@@ -232,9 +486,7 @@ def prepare_questions(questions_json, q_id):
     #    ques_dict[q['question_id']] = q
    # questions = [ques_dict[i]['question'] for i in q_id]
     for question in questions:
-        question = question.lower()[:-1]
-        question = _special_chars.sub('', question)
-        yield question.split(' ')
+        yield tokenize_question(question)
 
 def prepare_questions_from_para(paraphrases):
     for paraphrase in paraphrases:
@@ -255,23 +507,24 @@ def prepare_answers(answers_json, q_id):
     # normalizations is not needed, assuming that the human answers are already normalized.
     # [0]: http://visualqa.org/evaluation.html
     # [1]: https://github.com/VT-vision-lab/VQA/blob/3849b1eae04a0ffd83f56ad6f70ebd0767e09e0f/PythonEvaluationTools/vqaEvaluation/vqaEval.py#L96
-
-    def process_punctuation(s):
-        # the original is somewhat broken, so things that look odd here might just be to mimic that behaviour
-        # this version should be faster since we use re instead of repeated operations on str's
-        if _punctuation.search(s) is None:
-            return s
-        s = _punctuation_with_a_space.sub('', s)
-        if re.search(_comma_strip, s) is not None:
-            s = s.replace(',', '')
-        s = _punctuation.sub(' ', s)
-        s = _period_strip.sub('', s)
-        return s.strip()
-
     for answer_list in answers:
         yield list(map(process_punctuation, answer_list))
 
 
+def process_punctuation(s):
+    """ Normalize the punctuation of a single answer """
+    # the original is somewhat broken, so things that look odd here might just be to mimic that behaviour
+    # this version should be faster since we use re instead of repeated operations on str's
+    if _punctuation.search(s) is None:
+        return s
+    s = _punctuation_with_a_space.sub('', s)
+    if re.search(_comma_strip, s) is not None:
+        s = s.replace(',', '')
+    s = _punctuation.sub(' ', s)
+    s = _period_strip.sub('', s)
+    return s.strip()
+
+
 class CocoImages(data.Dataset):
     """ Dataset for MSCOCO images located in a folder on the filesystem """
     def __init__(self, path, transform=None):
@@ -295,6 +548,7 @@ class CocoImages(data.Dataset):
     def __getitem__(self, item):
         id = self.sorted_ids[item]
         path = os.path.join(self.path, self.id_to_filename[id])
+        from PIL import Image
         img = Image.open(path).convert('RGB')
 
         if self.transform is not None:
@@ -0,0 +1,744 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+
+import h5py
+import numpy as np
+import torch
+
+import config
+
+
+SHARED_MEMORY_ROOT = '/dev/shm'
+
+
+# stores opened through open_shared, by process and path
+_shared_stores = {}
+
+
+def open_features(path):
+    """ Open the preprocessed feature store at `path`; a directory is a memory-mapped store (or a striped one, if it
+        has a stripes.json), anything else an h5 file. A list of paths is opened as one MultiFeatures store spanning all of them.
+    """
+    if isinstance(path, (list, tuple)):
+        return MultiFeatures([open_features(p) for p in path])
+    if os.path.exists(os.path.join(path, 'stripes.json')):
+        return StripedFeatures(path)
+    if os.path.isdir(path):
+        return MmapFeatures(path)
+    return H5Features(path)
+
+
+def open_shared(path):
+    """ Like open_features, but every process opens the store at `path` only once and hands out that same object,
+        so all datasets of a run share its mappings and id index. Keyed by pid, so forked children open their own.
+    """
+    key = (os.getpid(), tuple(path) if isinstance(path, (list, tuple)) else path)
+    if key not in _shared_stores:
+        _shared_stores[key] = open_features(path)
+    return _shared_stores[key]
+
+
+def shared_features_path(name, test=False):
+    """ Location of the node-wide shared-memory copy of a feature store, as filled by data/share-features.py """
+    return os.path.join(SHARED_MEMORY_ROOT, '{}-{}'.format(name, 'test' if test else 'trainval'))
+
+
+def create_features(path, backend=None, append=False, ragged=False, dtype='float32', normalized_boxes=False, normalized_features=False,
+                    stripes=None):
+    """ Create a writer for a feature store at `path`, or reopen the existing one to add images to it if `append`.
+        A `ragged` store keeps only the real boxes of every image instead of padding them to config.output_size,
+        `dtype` 'float16' or 'int8' stores the features with reduced precision.
+        `normalized_boxes` and `normalized_features` record that the appended boxes are divided by the image size
+        and the features L2-normalized per box, so that readers don't have to do it again.
+        With a list of `stripes` directories, the mmap store is striped across them (see StripedFeatures).
+    """
+    backend = backend or config.feature_backend
+    if backend == 'h5':
+        if ragged or dtype != 'float32' or stripes:
+            raise ValueError('only the mmap backend supports ragged, striped and reduced-precision feature stores')
+        return H5FeatureWriter(path, append, normalized_boxes, normalized_features)
+    elif backend == 'mmap':
+        if stripes:
+            return StripedFeatureWriter(path, stripes, append, ragged, dtype, normalized_boxes, normalized_features)
+        return MmapFeatureWriter(path, append, ragged, dtype, normalized_boxes, normalized_features)
+    raise ValueError('unknown feature backend: {}'.format(backend))
+
+
+def _runs(indices):
+    """ Split sorted distinct row indices into (start, end) ranges of adjacent rows """
+    runs = []
+    for index in indices:
+        if runs and runs[-1][1] == index:
+            runs[-1][1] = index + 1
+        else:
+            runs.append([index, index + 1])
+    return runs
+
+
+# int8 features of a reduced-precision store together with the float32 scale of every box
+QuantizedFeatures = collections.namedtuple('QuantizedFeatures', ['values', 'scales'])
+
+
+class IdIndex:
+    """ Maps COCO image ids to rows of a feature store by binary search over the sorted ids.
+
+        Persisted next to the store as one int64 [2, num_images] .npy of the sorted ids and their rows,
+        which is memory-mapped, so opening it takes the same time however many images the store holds.
+        A .signature file next to it holds the hash of the store's ids it was built from.
+    """
+    def __init__(self, sorted_ids, rows):
+        self.sorted_ids = sorted_ids
+        self.rows = rows
+
+    @classmethod
+    def build(cls, ids):
+        ids = np.asarray(ids, dtype='int64')
+        order = np.argsort(ids, kind='stable')
+        return cls(ids[order], order)
+
+    @classmethod
+    def load(cls, path):
+        index = np.load(path, mmap_mode='r')
+        return cls(index[0], index[1])
+
+    def save(self, path, signature):
+        tmp_path = '{}.tmp-{}.npy'.format(path, os.getpid())
+        np.save(tmp_path, np.stack([self.sorted_ids, self.rows]))
+        os.replace(tmp_path, path)
+        tmp_path = '{}.signature.tmp-{}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            fd.write(signature)
+        os.replace(tmp_path, path + '.signature')
+
+    def __len__(self):
+        return len(self.sorted_ids)
+
+    def rows_of(self, image_ids):
+        """ Rows of the images with `image_ids` """
+        image_ids = np.asarray(image_ids, dtype='int64')
+        positions = np.searchsorted(self.sorted_ids, image_ids).clip(max=len(self) - 1)
+        found = self.sorted_ids[positions] == image_ids
+        if not found.all():
+            raise KeyError('images not in the feature store: {}'.format(image_ids[~found][:10].tolist()))
+        return np.asarray(self.rows[positions])
+
+
+def _ids_signature(ids):
+    return hashlib.sha1(np.ascontiguousarray(ids, dtype='int64').tobytes()).hexdigest()
+
+
+def _save_id_index(path, ids):
+    """ Build the id index of a store with `ids` and persist it at `path`, as written stores do when they are closed """
+    IdIndex.build(ids).save(path, _ids_signature(ids))
+
+
+def _open_id_index(path, store):
+    """ The persisted id index of `store` at `path`, rebuilt (and saved if possible) when it is missing or outdated """
+    ids = store.ids()
+    signature = _ids_signature(ids)
+    if os.path.exists(path) and os.path.exists(path + '.signature'):
+        with open(path + '.signature', 'r') as fd:
+            # the store may have been rebuilt since, with other images or the same ones in another order
+            if fd.read() == signature:
+                return IdIndex.load(path)
+    index = IdIndex.build(ids)
+    try:
+        index.save(path, signature)
+    except OSError:
+        # read-only location, the index is simply rebuilt the next time
+        pass
+    return index
+
+
+class H5Features:
+    """ Features in the original h5 layout: [num_images, output_features, output_size] plus boxes and image sizes """
+    in_memory = False
+    memory_mapped = False
+    ragged = False
+
+    def __init__(self, path):
+        self.path = path
+        with h5py.File(self.path, 'r') as features_file:
+            self.num_images = features_file['ids'].shape[0]
+            self.normalized_boxes = bool(features_file.attrs.get('normalized_boxes', False))
+            self.normalized_features = bool(features_file.attrs.get('normalized_features', False))
+        self._id_index = None
+
+    def __len__(self):
+        return self.num_images
+
+    def ids(self):
+        with h5py.File(self.path, 'r') as features_file:
+            return features_file['ids'][()]
+
+    def id_index(self):
+        if self._id_index is None:
+            self._id_index = _open_id_index(self.path + '.id-index.npy', self)
+        return self._id_index
+
+    def _open(self):
+        if not hasattr(self, 'features_file'):
+            # Loading the h5 file has to be done here and not in __init__ because when the DataLoader
+            # forks for multiple works, every child would use the same file object and fail
+            # Having multiple readers using different file objects is fine though, so we just init in here.
+            self.features_file = h5py.File(self.path, 'r')
+            # stores written before the box counts were kept have to count the non-zero boxes on every read
+            self.num_boxes = self.features_file['num_boxes'][()] if 'num_boxes' in self.features_file else None
+
+    def load(self, index):
+        """ Load the features of the image in row `index` as (v, b, obj_mask, width, height) """
+        self._open()
+        img = self.features_file['features'][index]
+        boxes = self.features_file['boxes'][index]
+        widths = self.features_file['widths'][index]
+        heights = self.features_file['heights'][index]
+        return self._image(img, boxes, widths, heights, self._num_boxes(index, img))
+
+    def load_many(self, indices):
+        """ Load the images in rows `indices` like `load`, reading every run of adjacent rows with one slice in storage order """
+        self._open()
+        images = {}
+        for start, end in _runs(sorted(set(indices))):
+            img = self.features_file['features'][start:end]
+            boxes = self.features_file['boxes'][start:end]
+            widths = self.features_file['widths'][start:end]
+            heights = self.features_file['heights'][start:end]
+            for i in range(end - start):
+                images[start + i] = self._image(img[i], boxes[i], widths[i], heights[i], self._num_boxes(start + i, img[i]))
+        return [images[index] for index in indices]
+
+    def _num_boxes(self, index, img):
+        if self.num_boxes is not None:
+            return self.num_boxes[index]
+        return (img.sum(0) > 0).sum()
+
+    @staticmethod
+    def _image(img, boxes, widths, heights, num_boxes):
+        obj_mask = (np.arange(img.shape[1]) < num_boxes).astype(int)
+        return torch.from_numpy(img).transpose(0,1), torch.from_numpy(boxes).transpose(0,1), torch.from_numpy(obj_mask), widths, heights
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('features_file', None)
+        return state
+
+
+class MmapFeatures:
+    """ Features in a flat binary file that is memory-mapped in the layout the model consumes.
+
+        `path` is a directory written by MmapFeatureWriter:
+            features.bin  float32 [num_images, output_size, output_features], row-major
+                          (or float16, or int8 with a float32 scale per box in scales.bin [num_images, output_size])
+            boxes.bin     float32 [num_images, output_size, 4]
+            index.npz     ids, widths, heights and num_boxes of every image
+            id-index.npy  the IdIndex of the store
+            meta.json     shapes, dtype, layout and whether boxes/features are stored normalized,
+                          written last so that a partial store is never opened
+        In the 'ragged' layout the rows of all images are concatenated without padding,
+        features.bin is [total_boxes, output_features] and image i starts at row sum(num_boxes[:i]).
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            raise RuntimeError('{} is not a complete feature store (still being written?)'.format(path))
+        # a store in shared memory is already in RAM once per node, caching it again per worker only wastes memory
+        self.in_memory = os.path.realpath(path).startswith(SHARED_MEMORY_ROOT + os.sep)
+        # loads are views into the mapping, which the page cache already keeps
+        self.memory_mapped = True
+        with open(os.path.join(path, 'meta.json'), 'r') as fd:
+            self.meta = json.load(fd)
+        with np.load(os.path.join(path, 'index.npz')) as index:
+            self.index = {k: index[k] for k in index.files}
+        self.ragged = self.meta.get('layout') == 'ragged'
+        self.normalized_boxes = self.meta.get('normalized_boxes', False)
+        self.normalized_features = self.meta.get('normalized_features', False)
+        if self.ragged:
+            self.offsets = np.concatenate([[0], np.cumsum(self.index['num_boxes'], dtype='int64')])
+        self._id_index = None
+
+    def __len__(self):
+        return self.meta['num_images']
+
+    def ids(self):
+        return self.index['ids']
+
+    def id_index(self):
+        if self._id_index is None:
+            self._id_index = _open_id_index(os.path.join(self.path, 'id-index.npy'), self)
+        return self._id_index
+
+    def _open(self):
+        if self.ragged:
+            rows = (int(self.offsets[-1]),)
+        else:
+            rows = (self.meta['num_images'], self.meta['output_size'])
+        # copy-on-write mappings are writable, so torch.from_numpy doesn't complain, but reads still share the page cache
+        self.features = np.memmap(os.path.join(self.path, 'features.bin'), dtype=self.meta['dtype'], mode='c',
+                                  shape=rows + (self.meta['output_features'],))
+        self.boxes = np.memmap(os.path.join(self.path, 'boxes.bin'), dtype='float32', mode='c', shape=rows + (4,))
+        if self.meta['dtype'] == 'int8':
+            self.scales = np.memmap(os.path.join(self.path, 'scales.bin'), dtype='float32', mode='c', shape=rows)
+
+    def load(self, index):
+        """ Load the features of the image in row `index` as (v, b, obj_mask, width, height) """
+        if not hasattr(self, 'features'):
+            self._open()
+        num_boxes = self.index['num_boxes'][index]
+        if self.ragged:
+            rows = slice(self.offsets[index], self.offsets[index + 1])
+            obj_mask = np.ones(num_boxes, dtype=int)
+        else:
+            rows = index
+            obj_mask = (np.arange(self.meta['output_size']) < num_boxes).astype(int)
+        # a view into the mapping, no copy: it must never be written to, the pages may be shared with other
+        # processes (or read-only in /dev/shm). Features are normalized when the store is built, see preprocess-features.py
+        v = torch.from_numpy(self.features[rows])
+        if self.meta['dtype'] == 'int8':
+            # dequantized only once the batch is on its device, see data.features_to_cuda
+            v = QuantizedFeatures(v, torch.from_numpy(self.scales[rows]))
+        # boxes are tiny, copied so that callers get memory of their own (features.rescale_boxes returns new tensors anyway)
+        b = torch.from_numpy(np.array(self.boxes[rows]))
+        return v, b, torch.from_numpy(obj_mask), self.index['widths'][index], self.index['heights'][index]
+
+    def load_many(self, indices):
+        """ Load the images in rows `indices` like `load`, going through the mapping in storage order.
+            The features are views that are only read when they are copied, see data._pad_objects.
+        """
+        images = {index: self.load(index) for index in sorted(set(indices))}
+        return [images[index] for index in indices]
+
+    def read(self, index):
+        """ Like `load`, but the features are read into new memory with pread instead of handed out as a view
+            of the mapping. pread releases the GIL, so threads reading from different drives run in parallel.
+        """
+        if not hasattr(self, 'fds') or self.fds_pid != os.getpid():
+            # raw descriptors, shared by the threads of this process since pread keeps no file position
+            self.fds = {name: os.open(os.path.join(self.path, name + '.bin'), os.O_RDONLY)
+                        for name in ('features', 'scales') if os.path.exists(os.path.join(self.path, name + '.bin'))}
+            self.fds_pid = os.getpid()
+        num_boxes = self.index['num_boxes'][index]
+        if self.ragged:
+            start, count = int(self.offsets[index]), int(num_boxes)
+        else:
+            start, count = index * self.meta['output_size'], self.meta['output_size']
+        v = torch.from_numpy(self._pread('features', start, count, (self.meta['output_features'],), self.meta['dtype']))
+        if self.meta['dtype'] == 'int8':
+            v = QuantizedFeatures(v, torch.from_numpy(self._pread('scales', start, count, (), 'float32')))
+        _, b, obj_mask, width, height = self.load(index)
+        return v, b, obj_mask, width, height
+
+    def _pread(self, name, start, count, row_shape, dtype):
+        row_bytes = int(np.prod(row_shape, dtype='int64')) * np.dtype(dtype).itemsize
+        buf = bytearray(count * row_bytes)
+        view = memoryview(buf)
+        done = 0
+        while done < len(buf):
+            n = os.preadv(self.fds[name], [view[done:]], start * row_bytes + done)
+            if n == 0:
+                raise IOError('{} ends before row {}'.format(os.path.join(self.path, name + '.bin'), start + count))
+            done += n
+        return np.frombuffer(buf, dtype=dtype).reshape((count,) + row_shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('features', None)
+        state.pop('boxes', None)
+        state.pop('scales', None)
+        state.pop('fds', None)
+        return state
+
+
+class StripedFeatures:
+    """ A memory-mapped store striped across several directories, usually one per drive.
+
+        `path` holds stripes.json with the directories of the stripes and the store's id-index.npy, every stripe
+        is a complete MmapFeatures store: image i of the striped store is image i // N of stripe i % N.
+        load_many reads the images of every stripe from its own thread, so the reads of a batch go to all drives at once
+        and the read bandwidth adds up. The thread pool is started per process (and so per data worker).
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'stripes.json'), 'r') as fd:
+            self.stripes = [MmapFeatures(stripe) for stripe in json.load(fd)['stripes']]
+        self.in_memory = all(stripe.in_memory for stripe in self.stripes)
+        self.memory_mapped = True
+        self.ragged = self.stripes[0].ragged
+        self.normalized_boxes = self.stripes[0].normalized_boxes
+        self.normalized_features = self.stripes[0].normalized_features
+        self._id_index = None
+        self.pool = None
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self.stripes)
+
+    def ids(self):
+        ids = np.zeros(len(self), dtype='int64')
+        for i, stripe in enumerate(self.stripes):
+            ids[i::len(self.stripes)] = stripe.ids()
+        return ids
+
+    def id_index(self):
+        if self._id_index is None:
+            self._id_index = _open_id_index(os.path.join(self.path, 'id-index.npy'), self)
+        return self._id_index
+
+    def load(self, index):
+        """ Load the features of the image in row `index` as (v, b, obj_mask, width, height) """
+        return self.stripes[index % len(self.stripes)].load(index // len(self.stripes))
+
+    def load_many(self, indices):
+        """ Load the images in rows `indices` like `load`, reading all stripes in parallel, each in storage order """
+        if self.pool is None or self.pool_pid != os.getpid():
+            self.pool = concurrent.futures.ThreadPoolExecutor(len(self.stripes))
+            self.pool_pid = os.getpid()
+        by_stripe = collections.defaultdict(set)
+        for index in indices:
+            by_stripe[index % len(self.stripes)].add(index)
+
+        def read(stripe, rows):
+            return {row: self.stripes[stripe].read(row // len(self.stripes)) for row in sorted(rows)}
+
+        images = {}
+        for future in [self.pool.submit(read, stripe, rows) for stripe, rows in by_stripe.items()]:
+            images.update(future.result())
+        return [images[index] for index in indices]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        return state
+
+
+class MultiFeatures:
+    """ One logical store over several physical ones (e.g. the trainval and test stores),
+        with the rows of all of them numbered consecutively in the order of `stores`
+    """
+    def __init__(self, stores):
+        self.stores = stores
+        self.starts = np.cumsum([0] + [len(store) for store in stores])
+        self.in_memory = all(store.in_memory for store in stores)
+        self.memory_mapped = any(store.memory_mapped for store in stores)
+        for flag in ('normalized_boxes', 'normalized_features'):
+            if len(set(getattr(store, flag) for store in stores)) > 1:
+                raise ValueError('feature stores disagree on {}, rebuild them with the same options'.format(flag))
+            setattr(self, flag, getattr(stores[0], flag))
+        self._id_index = None
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def ids(self):
+        return np.concatenate([store.ids() for store in self.stores])
+
+    def id_index(self):
+        if self._id_index is None:
+            # merged from the persisted indexes of the parts, so the ids are never sorted again
+            parts = [store.id_index() for store in self.stores]
+            sorted_ids = np.concatenate([part.sorted_ids for part in parts])
+            rows = np.concatenate([part.rows + start for part, start in zip(parts, self.starts)])
+            order = np.argsort(sorted_ids, kind='stable')
+            self._id_index = IdIndex(sorted_ids[order], rows[order])
+        return self._id_index
+
+    def _locate(self, index):
+        part = int(np.searchsorted(self.starts, index, side='right')) - 1
+        return self.stores[part], index - int(self.starts[part])
+
+    def load(self, index):
+        """ Load the features of the image in row `index` as (v, b, obj_mask, width, height) """
+        store, row = self._locate(index)
+        return store.load(row)
+
+    def load_many(self, indices):
+        """ Load the images in rows `indices` like `load`, with one load_many per part """
+        by_store = collections.defaultdict(list)
+        for index in indices:
+            store, row = self._locate(index)
+            by_store[id(store)].append((index, store, row))
+        images = {}
+        for entries in by_store.values():
+            store = entries[0][1]
+            for (index, _, _), image in zip(entries, store.load_many([row for _, _, row in entries])):
+                images[index] = image
+        return [images[index] for index in indices]
+
+
+class FeatureCache:
+    """ LRU cache of loaded images with a byte budget.
+
+        Keyed by COCO image id, holding the (v, b, obj_mask, width, height) tuples returned by VQA._load_images.
+        Every DataLoader worker gets its own copy when it forks. Only used for h5 stores: the images of a
+        memory-mapped store are views into the mapping, caching them would save no reads.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(image):
+        tensors = []
+        for t in image:
+            tensors.extend(t if isinstance(t, QuantizedFeatures) else [t])
+        return sum(t.element_size() * t.nelement() for t in tensors if torch.is_tensor(t))
+
+    def get(self, image_id):
+        entry = self.entries.get(image_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(image_id)
+        return entry[0]
+
+    def put(self, image_id, image):
+        size = self._size(image)
+        if size > self.max_bytes or image_id in self.entries:
+            return
+        while self.bytes + size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+        self.entries[image_id] = (image, size)
+        self.bytes += size
+
+    def __repr__(self):
+        return 'FeatureCache({} images, {:.1f} MiB, {} hits, {} misses, {} evictions)'.format(
+            len(self.entries), self.bytes / 2 ** 20, self.hits, self.misses, self.evictions)
+
+
+class H5FeatureWriter:
+    """ Write features into the original h5 layout.
+
+        Images are appended one at a time, and the datasets are resizable so that an existing store can be reopened
+        to add more images or truncated back to the last checkpoint of an interrupted run.
+    """
+    def __init__(self, path, append=False, normalized_boxes=False, normalized_features=False):
+        self.fd = h5py.File(path, 'a' if append else 'w', libver='latest')
+        if append and 'ids' in self.fd:
+            if self.fd['ids'].maxshape[0] is not None or 'num_boxes' not in self.fd:
+                raise RuntimeError('{} has a fixed size or no box counts, rebuild it to be able to add images'.format(path))
+            self.features = self.fd['features']
+            self.boxes = self.fd['boxes']
+            self.coco_ids = self.fd['ids']
+            self.widths = self.fd['widths']
+            self.heights = self.fd['heights']
+            self.num_boxes = self.fd['num_boxes']
+        else:
+            features_shape = (config.output_features, config.output_size)
+            boxes_shape = (4, config.output_size)
+            self.features = self.fd.create_dataset('features', shape=(0,) + features_shape, maxshape=(None,) + features_shape,
+                                                   chunks=(1,) + features_shape, dtype='float32')
+            self.boxes = self.fd.create_dataset('boxes', shape=(0,) + boxes_shape, maxshape=(None,) + boxes_shape,
+                                                chunks=(1,) + boxes_shape, dtype='float32')
+            self.coco_ids = self.fd.create_dataset('ids', shape=(0,), maxshape=(None,), dtype='int32')
+            self.widths = self.fd.create_dataset('widths', shape=(0,), maxshape=(None,), dtype='int32')
+            self.heights = self.fd.create_dataset('heights', shape=(0,), maxshape=(None,), dtype='int32')
+            self.num_boxes = self.fd.create_dataset('num_boxes', shape=(0,), maxshape=(None,), dtype='int32')
+        self.fd.attrs['normalized_boxes'] = normalized_boxes
+        self.fd.attrs['normalized_features'] = normalized_features
+
+    def __len__(self):
+        return self.coco_ids.shape[0]
+
+    def truncate(self, num_images):
+        for dataset in (self.features, self.boxes, self.coco_ids, self.widths, self.heights, self.num_boxes):
+            dataset.resize(num_images, axis=0)
+
+    def append(self, image_id, width, height, features, boxes):
+        """ Add an image with features [num_boxes, output_features] and boxes [num_boxes, 4] """
+        i = len(self)
+        self.truncate(i + 1)
+        self.coco_ids[i] = image_id
+        self.widths[i] = width
+        self.heights[i] = height
+        self.num_boxes[i] = features.shape[0]
+        self.features[i, :, :features.shape[0]] = features.transpose()
+        self.boxes[i, :, :boxes.shape[0]] = boxes.transpose()
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        _save_id_index(self.fd.filename + '.id-index.npy', self.coco_ids[()])
+        self.fd.close()
+
+
+class MmapFeatureWriter:
+    """ Write features into the memory-mapped layout read by MmapFeatures.
+
+        Images are appended to the binary files; the index is kept in memory and saved on flush,
+        and meta.json is only written on close, so readers never open a store that is still being written.
+        Features are stored as float32, float16 or int8 with one float32 scale per box (`dtype`).
+    """
+    INDEX_FIELDS = ('ids', 'widths', 'heights', 'num_boxes')
+
+    def __init__(self, path, append=False, ragged=False, dtype='float32', normalized_boxes=False, normalized_features=False):
+        if dtype not in ('float32', 'float16', 'int8'):
+            raise ValueError('unsupported feature dtype: {}'.format(dtype))
+        self.path = path
+        self.ragged = ragged
+        self.dtype = dtype
+        self.normalized_boxes = normalized_boxes
+        self.normalized_features = normalized_features
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        index_path = os.path.join(path, 'index.npz')
+        if append and os.path.exists(index_path):
+            with np.load(index_path) as index:
+                self.index = {k: index[k].tolist() for k in self.INDEX_FIELDS}
+            mode = 'r+b'
+        else:
+            self.index = {k: [] for k in self.INDEX_FIELDS}
+            mode = 'w+b'
+        # the open binary files with the number of bytes every box takes in them
+        self.files = {
+            'features': (open(os.path.join(path, 'features.bin'), mode), config.output_features * np.dtype(dtype).itemsize),
+            'boxes': (open(os.path.join(path, 'boxes.bin'), mode), 4 * 4),
+        }
+        if dtype == 'int8':
+            self.files['scales'] = (open(os.path.join(path, 'scales.bin'), mode), 4)
+        self.feature_row = np.zeros((config.output_size, config.output_features), dtype='float32')
+        self.box_row = np.zeros((config.output_size, 4), dtype='float32')
+        self.truncate(len(self))
+
+    def __len__(self):
+        return len(self.index['ids'])
+
+    def truncate(self, num_images):
+        for k in self.INDEX_FIELDS:
+            del self.index[k][num_images:]
+        # number of box rows taken by the remaining images
+        if self.ragged:
+            self.rows = sum(self.index['num_boxes'])
+        else:
+            self.rows = num_images * config.output_size
+        for fd, row_bytes in self.files.values():
+            fd.truncate(self.rows * row_bytes)
+
+    def _write(self, name, array):
+        fd, row_bytes = self.files[name]
+        fd.seek(self.rows * row_bytes)
+        fd.write(np.ascontiguousarray(array).tobytes())
+
+    def append(self, image_id, width, height, features, boxes):
+        """ Add an image with features [num_boxes, output_features] and boxes [num_boxes, 4] """
+        num_boxes = features.shape[0]
+        self.index['ids'].append(image_id)
+        self.index['widths'].append(width)
+        self.index['heights'].append(height)
+        self.index['num_boxes'].append(num_boxes)
+        if self.ragged:
+            feature_row, box_row = features, boxes
+        else:
+            feature_row, box_row = self.feature_row, self.box_row
+            feature_row[:num_boxes] = features
+            feature_row[num_boxes:] = 0
+            box_row[:num_boxes] = boxes
+            box_row[num_boxes:] = 0
+        if self.dtype == 'int8':
+            values, scales = quantize(feature_row)
+            self._write('features', values)
+            self._write('scales', scales)
+        else:
+            self._write('features', feature_row.astype(self.dtype, copy=False))
+        self._write('boxes', box_row.astype('float32', copy=False))
+        self.rows += box_row.shape[0]
+
+    def flush(self):
+        for fd, _ in self.files.values():
+            fd.flush()
+        index = {k: np.array(v, dtype='int32') for k, v in self.index.items()}
+        tmp_path = os.path.join(self.path, 'index.tmp.npz')
+        np.savez(tmp_path, **index)
+        os.replace(tmp_path, os.path.join(self.path, 'index.npz'))
+
+    def close(self):
+        self.flush()
+        for fd, _ in self.files.values():
+            fd.close()
+        _save_id_index(os.path.join(self.path, 'id-index.npy'), self.index['ids'])
+        meta = {
+            'num_images': len(self),
+            'output_size': config.output_size,
+            'output_features': config.output_features,
+            'dtype': self.dtype,
+            'layout': 'ragged' if self.ragged else 'padded',
+            'normalized_boxes': self.normalized_boxes,
+            'normalized_features': self.normalized_features,
+        }
+        with open(os.path.join(self.path, 'meta.json'), 'w') as fd:
+            json.dump(meta, fd)
+
+
+def rescale_boxes(b, width, height, normalized):
+    """ Boxes [num_boxes, 4] of an image from a store whose boxes are `normalized` (divided by the image size) or not,
+        in the form config.normalize_box asks for
+    """
+    if config.normalize_box == normalized:
+        return b
+    assert b.shape[1] == 4
+    scale = b.new_tensor([width, height, width, height], dtype=torch.float)
+    return b / scale if config.normalize_box else b * scale
+
+
+class StripedFeatureWriter:
+    """ Writes a StripedFeatures store: image i goes to the MmapFeatureWriter of stripe i % len(stripes) """
+    def __init__(self, path, stripes, append=False, ragged=False, dtype='float32', normalized_boxes=False, normalized_features=False):
+        self.path = path
+        self.stripe_paths = [os.path.abspath(stripe) for stripe in stripes]
+        os.makedirs(path, exist_ok=True)
+        stripes_path = os.path.join(path, 'stripes.json')
+        if os.path.exists(stripes_path):
+            # like meta.json of a single store, only written once the store is complete
+            os.remove(stripes_path)
+        self.writers = [MmapFeatureWriter(stripe, append, ragged, dtype, normalized_boxes, normalized_features)
+                        for stripe in self.stripe_paths]
+
+    def __len__(self):
+        return sum(len(writer) for writer in self.writers)
+
+    def truncate(self, num_images):
+        n = len(self.writers)
+        for i, writer in enumerate(self.writers):
+            writer.truncate((num_images - i + n - 1) // n)
+
+    def append(self, image_id, width, height, features, boxes):
+        """ Add an image with features [num_boxes, output_features] and boxes [num_boxes, 4] """
+        self.writers[len(self) % len(self.writers)].append(image_id, width, height, features, boxes)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        ids = np.zeros(len(self), dtype='int64')
+        for i, writer in enumerate(self.writers):
+            writer.close()
+            ids[i::len(self.writers)] = writer.index['ids']
+        _save_id_index(os.path.join(self.path, 'id-index.npy'), ids)
+        with open(os.path.join(self.path, 'stripes.json'), 'w') as fd:
+            json.dump({'stripes': self.stripe_paths}, fd)
+
+
+def quantize(features):
+    """ Quantize [num_boxes, output_features] float features to int8 with one scale per box """
+    scales = np.abs(features).max(axis=1) / 127
+    safe_scales = np.where(scales > 0, scales, 1)
+    values = np.clip(np.round(features / safe_scales[:, None]), -127, 127).astype('int8')
+    return values, scales.astype('float32')
+
+
+def dequantize(v):
+    """ Turn features loaded from a reduced-precision store back into float32 (on whatever device they are) """
+    if isinstance(v, QuantizedFeatures):
+        return v.values.float() * v.scales.unsqueeze(-1)
+    return v.float()
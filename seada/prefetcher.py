@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+
+import torch
+
+from . import features
+
+
+class DevicePrefetcher:
+    """ Iterate over a loader with every batch already on `device`, moving batch N+1 there while batch N is used.
+
+        On a gpu the copies are issued non-blocking on a side stream, elsewhere a background thread fetches
+        the next batch. `wait_time` is how long the consumer was blocked waiting for input during the last pass,
+        compared to `elapsed` it tells whether training is input-bound.
+    """
+    def __init__(self, loader, device=None):
+        self.loader = loader
+        self.dataset = loader.dataset
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.wait_time = 0.0
+        self.elapsed = 0.0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        start = time.time()
+        batches = self._iter_cuda() if self.device.type == 'cuda' else self._iter_thread()
+        for batch in batches:
+            yield batch
+        self.elapsed = time.time() - start
+
+    def summary(self):
+        share = self.wait_time / self.elapsed if self.elapsed else 0
+        return 'waited {:.1f}s of {:.1f}s for input ({:.1%})'.format(self.wait_time, self.elapsed, share)
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(self.device)
+        copied = None
+        batches = iter(self.loader)
+
+        def stage():
+            # the loader may reuse the memory of a batch once the next one is requested (see ring_loader),
+            # so the copies out of it have to be finished first
+            if copied is not None:
+                copied.synchronize()
+            start = time.time()
+            batch = next(batches, None)
+            self.wait_time += time.time() - start
+            if batch is None:
+                return None, None
+            with torch.cuda.stream(stream):
+                batch = tuple(_to_device(field, self.device) for field in batch)
+                event = torch.cuda.Event()
+                event.record(stream)
+            return batch, event
+
+        batch, copied = stage()
+        while batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            for tensor in _tensors(batch):
+                # allocated on the side stream, but used on the current one from here on
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+            current = batch
+            batch, copied = stage()
+            yield current
+
+    def _iter_thread(self):
+        staged = queue.Queue(maxsize=2)
+        done = object()
+
+        def fetch():
+            try:
+                for batch in self.loader:
+                    # copied even on the same device, since the loader may reuse a batch's memory (see ring_loader)
+                    staged.put(tuple(_to_device(field, self.device, copy=True) for field in batch))
+            except Exception as e:
+                staged.put(e)
+            staged.put(done)
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        while True:
+            start = time.time()
+            batch = staged.get()
+            self.wait_time += time.time() - start
+            if batch is done:
+                break
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+        thread.join()
+
+
+def _to_device(field, device, copy=False):
+    if isinstance(field, features.QuantizedFeatures):
+        return features.QuantizedFeatures(*(_to_device(part, device, copy) for part in field))
+    if torch.is_tensor(field):
+        return field.to(device, non_blocking=True, copy=copy)
+    return field
+
+
+def _tensors(batch):
+    for field in batch:
+        if isinstance(field, features.QuantizedFeatures):
+            yield from field
+        elif torch.is_tensor(field):
+            yield field
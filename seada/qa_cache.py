@@ -0,0 +1,63 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+import config
+
+
+# bump whenever the arrays below or the way they are computed change, so that stale caches are not picked up
+FORMAT_VERSION = 2
+
+
+def cache_key(paths, vocab):
+    """ Hash of the contents of the question/answer jsons at `paths`, the vocab (a vocab.Vocab) and everything else the encoding depends on """
+    h = hashlib.sha1()
+    h.update(json.dumps([FORMAT_VERSION, config.max_q_length]).encode())
+    for path in paths:
+        h.update(os.path.basename(path).encode())
+        with open(path, 'rb') as fd:
+            for block in iter(lambda: fd.read(1 << 20), b''):
+                h.update(block)
+    h.update(vocab.digest().encode())
+    return h.hexdigest()
+
+
+def load(key):
+    """ Memory-map the cached arrays stored under `key`, or return None if there are none (or caching is disabled) """
+    if not config.qa_cache_path:
+        return None
+    path = os.path.join(config.qa_cache_path, key)
+    if not os.path.isdir(path):
+        return None
+    # copy-on-write like the feature store, so that torch.from_numpy doesn't complain about read-only arrays
+    return {filename[:-len('.npy')]: np.load(os.path.join(path, filename), mmap_mode='c')
+            for filename in os.listdir(path) if filename.endswith('.npy')}
+
+
+def save(key, arrays):
+    """ Store a dict of arrays under `key`. The directory is filled under a temporary name and renamed into place,
+        so concurrent jobs never see a partial cache and the first one to finish wins.
+    """
+    if not config.qa_cache_path:
+        return
+    path = os.path.join(config.qa_cache_path, key)
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another job has written the same cache in the meantime
+        shutil.rmtree(tmp_path)
+
+
+def encode_strings(strings):
+    """ Pack strings into one uint8 buffer of their utf-8 bytes plus an offsets array """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='int64')
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype='uint8'), offsets
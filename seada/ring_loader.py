@@ -0,0 +1,191 @@
+import math
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+import config
+from . import features
+
+
+# every tensor carved out of a slot starts at a multiple of this, which keeps copies to the gpu aligned
+_ALIGNMENT = 64
+
+
+def slot_bytes_for(dataset, batch_size):
+    """ Upper bound of the bytes one batch of a VQA dataset takes in a slot """
+    per_question = (
+        config.output_size * (config.output_features + 4 + 1 + 1) * 4  # v, b, v_mask and the scales of int8 features
+        + 2 * dataset.max_question_length * (8 + 4)  # q and q_adv with their masks
+        + len(dataset.vocab.answer) * 4  # a
+        + 5 * 8  # idx, ids and lengths
+    )
+    return batch_size * per_question + 16 * _ALIGNMENT
+
+
+class RingBufferLoader:
+    """ Drop-in replacement for the DataLoader of make_loader that moves batches through a ring buffer.
+
+        The buffer is one shared-memory block of `num_slots` fixed-size slots, allocated once and page-locked
+        in place, so copies from it to the gpu need no staging. Workers build every batch straight into a free slot
+        (VQA carves its large tensors out of the slot through `allocate`) and only pass the slot number and the
+        layout of the batch back, instead of one new shared-memory segment and file descriptor per tensor.
+        The training process reads the batch in place: its tensors are views into the slot, valid only until
+        the next batch is requested, so anything that should outlive the step has to be moved or cloned.
+        Workers are started once and kept across epochs.
+    """
+    def __init__(self, dataset, batch_sampler, num_workers, num_slots, slot_bytes, pin_memory=True):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.num_workers = max(num_workers, 1)
+        # every worker needs a slot to fill while the training process holds one
+        self.num_slots = max(num_slots, self.num_workers + 1)
+        self.slot_bytes = int(math.ceil(slot_bytes / _ALIGNMENT)) * _ALIGNMENT
+        self.pin_memory = pin_memory
+        self.workers = None
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def _start(self):
+        self.buffer = torch.zeros(self.num_slots * self.slot_bytes, dtype=torch.uint8).share_memory_()
+        if self.pin_memory and torch.cuda.is_available():
+            torch.cuda.check_error(torch.cuda.cudart().cudaHostRegister(self.buffer.data_ptr(), self.buffer.numel(), 0))
+        self.slots = self.buffer.numpy().reshape(self.num_slots, self.slot_bytes)
+        self.index_queue = mp.Queue()
+        self.result_queue = mp.Queue()
+        self.free_slots = list(range(self.num_slots))
+        self.in_flight = 0
+        self.workers = []
+        for _ in range(self.num_workers):
+            worker = mp.Process(
+                target=_worker_loop,
+                args=(self.dataset, self.buffer, self.slot_bytes, self.index_queue, self.result_queue),
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def __iter__(self):
+        if self.workers is None:
+            self._start()
+        # batches of an epoch that was left early are still being built, wait for their slots to come back
+        while self.in_flight:
+            _, slot, layout, _ = self._receive()
+            if layout is not None:
+                self.free_slots.append(slot)
+        batches = iter(self.batch_sampler)
+        results = {}
+        sent = received = 0
+        held = None
+        try:
+            while True:
+                while self.free_slots:
+                    items = next(batches, None)
+                    if items is None:
+                        break
+                    self.index_queue.put((sent, self.free_slots.pop(), items))
+                    self.in_flight += 1
+                    sent += 1
+                if received == sent:
+                    return
+                # batches may come back out of order, but are handed out in order
+                while received not in results:
+                    seq, slot, layout, error = self._receive()
+                    if error is not None:
+                        raise RuntimeError('error in ring buffer worker:\n{}'.format(error))
+                    results[seq] = slot, layout
+                slot, layout = results.pop(received)
+                received += 1
+                if held is not None:
+                    self.free_slots.append(held)
+                held = slot
+                yield tuple(self._view(slot, field) for field in layout)
+        finally:
+            if held is not None:
+                self.free_slots.append(held)
+            for slot, _ in results.values():
+                self.free_slots.append(slot)
+
+    def _receive(self):
+        result = self.result_queue.get()
+        self.in_flight -= 1
+        if result[2] is None:
+            # a failed batch never reaches the consumer, so its slot is free again right away
+            self.free_slots.append(result[1])
+        return result
+
+    def _view(self, slot, layout):
+        if layout is None:
+            return None
+        kind = layout[0]
+        if kind == 'tensor':
+            _, offset, dtype, shape = layout
+            array = self.slots[slot, offset:offset + _nbytes(shape, dtype)].view(dtype).reshape(shape)
+            return torch.from_numpy(array)
+        elif kind == 'quantized':
+            return features.QuantizedFeatures(self._view(slot, layout[1]), self._view(slot, layout[2]))
+        return layout[1]
+
+    def __del__(self):
+        if self.workers:
+            for _ in self.workers:
+                self.index_queue.put(None)
+            for worker in self.workers:
+                worker.join(timeout=5)
+
+
+def _nbytes(shape, dtype):
+    return int(np.prod(shape, dtype='int64')) * np.dtype(dtype).itemsize
+
+
+class _SlotAllocator:
+    """ Bump allocator that carves the tensors of one batch out of its slot """
+    def __init__(self, slot):
+        self.slot = slot
+        self.base = slot.ctypes.data
+        self.offset = 0
+
+    def allocate(self, shape, dtype):
+        dtype = torch.zeros(0, dtype=dtype).numpy().dtype
+        start = int(math.ceil(self.offset / _ALIGNMENT)) * _ALIGNMENT
+        end = start + _nbytes(shape, dtype)
+        if end > len(self.slot):
+            raise RuntimeError('batch does not fit into a ring buffer slot of {} bytes'.format(len(self.slot)))
+        self.offset = end
+        return torch.from_numpy(self.slot[start:end].view(dtype).reshape(shape))
+
+    def place(self, field):
+        """ Layout of a batch field in the slot, copying tensors there unless they were allocated in it """
+        if field is None:
+            return None
+        if isinstance(field, features.QuantizedFeatures):
+            return ('quantized', self.place(field.values), self.place(field.scales))
+        if not torch.is_tensor(field):
+            return ('object', field)
+        offset = field.data_ptr() - self.base
+        if not (field.is_contiguous() and 0 <= offset < len(self.slot)):
+            placed = self.allocate(field.shape, field.dtype)
+            placed.copy_(field)
+            offset = placed.data_ptr() - self.base
+        return ('tensor', offset, field.numpy().dtype.str, tuple(field.shape))
+
+
+def _worker_loop(dataset, buffer, slot_bytes, index_queue, result_queue):
+    torch.set_num_threads(1)
+    slots = buffer.numpy().reshape(-1, slot_bytes)
+    while True:
+        task = index_queue.get()
+        if task is None:
+            break
+        seq, slot, items = task
+        allocator = _SlotAllocator(slots[slot])
+        try:
+            dataset.allocate = allocator.allocate
+            batch = dataset[items]
+            result_queue.put((seq, slot, [allocator.place(field) for field in batch], None))
+        except Exception:
+            result_queue.put((seq, slot, None, traceback.format_exc()))
+        finally:
+            dataset.allocate = None
@@ -0,0 +1,166 @@
+import itertools
+import math
+import os
+
+import numpy as np
+
+
+def distributed_rank():
+    """ (rank, world_size) of this process, from the RANK and WORLD_SIZE variables set by torch.distributed launchers """
+    return int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+
+class ShuffledBatchSampler:
+    """ Batch sampler over consecutive or shuffled questions, seeded by epoch like the other samplers here,
+        so that every process of a distributed run draws the same order.
+    """
+    def __init__(self, num_items, batch_size, shuffle=True, seed=0):
+        self.num_items = num_items
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        indices = rng.permutation(self.num_items) if self.shuffle else np.arange(self.num_items)
+        for start in range(0, len(indices), self.batch_size):
+            yield indices[start:start + self.batch_size].tolist()
+
+    def __len__(self):
+        return math.ceil(self.num_items / self.batch_size)
+
+
+class ImageGroupedBatchSampler:
+    """ Batch sampler that keeps the questions about one image together in a batch.
+
+        VQA has about 5 questions per image, so reading each image's features once per batch instead of once
+        per question cuts feature I/O by about that ratio. The questions of an image are split into chunks of at most
+        `max_per_image` questions, the chunks are shuffled and then packed into batches of `batch_size` questions.
+        `image_ids` holds the COCO image id of every index into the dataset (see VQA.image_ids),
+        so the answerable/frac subsetting of VQA is respected.
+    """
+    def __init__(self, image_ids, batch_size, max_per_image=None, shuffle=True, seed=0):
+        self.batch_size = batch_size
+        self.max_per_image = max_per_image
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_items = len(image_ids)
+        order = np.argsort(image_ids, kind='stable')
+        boundaries = np.flatnonzero(np.diff(image_ids[order])) + 1
+        self.groups = np.split(order, boundaries)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _chunks(self, rng):
+        chunks = []
+        for group in self.groups:
+            if self.shuffle:
+                group = rng.permutation(group)
+            step = self.max_per_image or len(group)
+            chunks.extend(group[i:i + step] for i in range(0, len(group), step))
+        if self.shuffle:
+            chunks = [chunks[i] for i in rng.permutation(len(chunks))]
+        return chunks
+
+    def __iter__(self):
+        # seeded by epoch, so every epoch gets a new but reproducible order
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        indices = np.concatenate(self._chunks(rng))
+        for start in range(0, len(indices), self.batch_size):
+            yield indices[start:start + self.batch_size].tolist()
+
+    def __len__(self):
+        return math.ceil(self.num_items / self.batch_size)
+
+
+class LengthBucketedBatchSampler:
+    """ Batch sampler that puts questions of similar length into a batch.
+
+        VQA trims every batch to its longest question, so with similar lengths the embedding, GRU and masks
+        run on much smaller tensors, and batches come out almost sorted already, which makes their sort nearly free.
+        When shuffling, the questions are shuffled and cut into buckets of `bucket_batches` batches, every bucket is
+        sorted by length and the batches of all buckets are shuffled, so batches still change from epoch to epoch.
+        Without shuffling (evaluation), all questions are simply sorted by length.
+        `lengths` holds the question length of every index into the dataset (see VQA.item_lengths).
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_batches=100, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self, indices):
+        # longest first, like VQA sorts them for packed sequences
+        indices = indices[np.argsort(-self.lengths[indices], kind='stable')]
+        return [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+
+    def __iter__(self):
+        # seeded by epoch, so every epoch gets a new but reproducible order
+        rng = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        if self.shuffle:
+            order = rng.permutation(len(self.lengths))
+            bucket_size = self.batch_size * self.bucket_batches
+            batches = []
+            for start in range(0, len(order), bucket_size):
+                batches.extend(self._batches(order[start:start + bucket_size]))
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        else:
+            batches = self._batches(np.arange(len(self.lengths)))
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        # every bucket but the last holds a whole number of batches
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+
+class ShardedBatchSampler:
+    """ Batch sampler that splits the batches of another one between the processes of a distributed run.
+
+        Every rank iterates the same seeded `batch_sampler` in the same epoch, so all ranks agree on the global
+        order of batches, and keeps every `world_size`-th batch starting at its `rank`. Image-grouped and
+        length-bucketed batches are therefore kept intact, and since samplers work on positions into the
+        answerable (and frac-truncated) questions of VQA, the shards partition exactly those.
+        A rank only loads the images of its own batches, though every rank still builds the whole VQA split.
+        With `pad`, ranks that get one batch fewer repeat their first one, so that all ranks run the same number
+        of steps as DistributedDataParallel needs; without it (paraphrase generation) every batch is seen exactly once.
+    """
+    def __init__(self, batch_sampler, rank, world_size, pad=False):
+        self.batch_sampler = batch_sampler
+        self.rank = rank
+        self.world_size = world_size
+        self.pad = pad
+
+    def set_epoch(self, epoch):
+        self.batch_sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        first = None
+        count = 0
+        for batch in itertools.islice(self.batch_sampler, self.rank, None, self.world_size):
+            if first is None:
+                first = batch
+            count += 1
+            yield batch
+        if self.pad:
+            for _ in range(count, len(self)):
+                yield first
+
+    def __len__(self):
+        if self.pad:
+            return math.ceil(len(self.batch_sampler) / self.world_size)
+        return len(range(self.rank, len(self.batch_sampler), self.world_size))
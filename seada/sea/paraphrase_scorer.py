@@ -1,4 +1,5 @@
 from __future__ import print_function
+import concurrent.futures
 import time
 import os
 import copy
@@ -59,16 +60,13 @@ class ParaphraseScorer(object):
                  back_paths=DEFAULT_BACK_PATHS,
                  gpu_id=1):
         print('GPU ID', gpu_id)
-        self.to_translators = []
-        # self.to_scorers = []
-        self.back_translators = []
-        for f in to_paths:
-            translator = onmt_model.OnmtModel(f, gpu_id)
-            self.to_translators.append(translator)
-            # self.to_scorers.append(translator)
-        for f in back_paths:
-            translator = onmt_model.OnmtModel(f, gpu_id)
-            self.back_translators.append(translator)
+        # the checkpoints are loaded concurrently, reading them is most of the time spent here
+        with concurrent.futures.ThreadPoolExecutor(len(to_paths) + len(back_paths)) as pool:
+            to_translators = [pool.submit(onmt_model.OnmtModel, f, gpu_id) for f in to_paths]
+            back_translators = [pool.submit(onmt_model.OnmtModel, f, gpu_id) for f in back_paths]
+            self.to_translators = [translator.result() for translator in to_translators]
+            # self.to_scorers = self.to_translators
+            self.back_translators = [translator.result() for translator in back_translators]
         self.build_common_vocabs()
         self.last = None
 
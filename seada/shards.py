@@ -0,0 +1,194 @@
+import collections
+import io
+import json
+import math
+import os
+import tarfile
+
+import numpy as np
+import torch
+import torch.utils.data
+
+import config
+from . import features
+from . import samplers
+
+
+# tar shards are read front to back through a buffer of this size, so storage only sees large sequential reads
+_READ_BUFFER_BYTES = 16 << 20
+
+# the questions a data worker has left over at the end of its shards, with their images, merged into batches by ShardLoader
+Leftover = collections.namedtuple('Leftover', ['items', 'images'])
+
+
+def shards_dir_for(name):
+    """ Directory of the shards of the split `name` ('train', 'val', 'trainval' or 'test'), as written by data/make-shards.py """
+    return os.path.join(config.shards_path, name)
+
+
+def write_shard(path, images):
+    """ Write a tar shard of `images`, (image_id, width, height, v, b, question_ids) tuples with the real boxes only.
+        Every image is one .npz member, so the shard can be read in a single sequential pass.
+    """
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    with tarfile.open(tmp_path, 'w') as tar:
+        for image_id, width, height, v, b, question_ids in images:
+            buf = io.BytesIO()
+            np.savez(buf, image_id=image_id, width=width, height=height, v=v, b=b, question_ids=question_ids)
+            member = tarfile.TarInfo('{:012d}.npz'.format(image_id))
+            member.size = buf.tell()
+            buf.seek(0)
+            tar.addfile(member, buf)
+    os.rename(tmp_path, path)
+
+
+def read_shard(path):
+    """ Yield the images of a tar shard in storage order, as (image_id, image, question_ids) with an image like
+        a feature store loads it
+    """
+    with open(path, 'rb', buffering=_READ_BUFFER_BYTES) as fd:
+        # stream mode never seeks back, members are read as they come
+        with tarfile.open(fileobj=fd, mode='r|') as tar:
+            for member in tar:
+                with np.load(io.BytesIO(tar.extractfile(member).read())) as record:
+                    v = torch.from_numpy(record['v'])
+                    b = torch.from_numpy(record['b'])
+                    obj_mask = torch.ones(len(b), dtype=torch.long)
+                    image = v, b, obj_mask, int(record['width']), int(record['height'])
+                    yield int(record['image_id']), image, record['question_ids']
+
+
+class ShardStream(torch.utils.data.IterableDataset):
+    """ Batches of a VQA split streamed from tar shards that bundle the question ids of a set of images with their features.
+
+        Shards are shuffled every epoch and split between the data workers (and, if `shard`, the processes of a distributed run),
+        every worker reads its shards sequentially and passes the images through a shuffle buffer of `buffer_images`
+        images before their questions are packed into batches of `batch_size`. Questions that are not in the split
+        (not answerable, or cut by `frac`) are skipped. The batches are the same 14-field tuples VQA builds.
+        With several data workers, every worker ends with a Leftover of the questions that don't fill a batch,
+        which ShardLoader packs into the last batches of the epoch, so an epoch has exactly len(self) batches
+        (per process: with `shard`, the shards of a rank don't hold exactly its share of the questions).
+    """
+    def __init__(self, split, shard_dir, batch_size, shuffle=True, buffer_images=1000, seed=0, shard=False):
+        self.split = split
+        self.shard = shard
+        with open(os.path.join(shard_dir, 'meta.json'), 'r') as fd:
+            self.meta = json.load(fd)
+        if self.meta['normalized_features'] != config.v_feat_prenormalized:
+            raise RuntimeError('{} was written from a store with normalized_features={}, set config.v_feat_prenormalized accordingly'.format(
+                shard_dir, self.meta['normalized_features']))
+        self.paths = [os.path.join(shard_dir, name) for name in self.meta['shards']]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_images = buffer_images if shuffle else 0
+        self.seed = seed
+        self.epoch = 0
+        # dataset positions of the questions in the shards, looked up by question id
+        question_ids = np.asarray(split.question_ids)
+        if split.answerable_only:
+            question_ids = question_ids[split.answerable]
+        self.order = np.argsort(question_ids, kind='stable')
+        self.sorted_question_ids = question_ids[self.order]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _rank(self):
+        return samplers.distributed_rank() if self.shard else (0, 1)
+
+    def __len__(self):
+        _, world_size = self._rank()
+        return math.ceil(len(self.split) / self.batch_size / world_size)
+
+    def _positions(self, question_ids):
+        positions = np.searchsorted(self.sorted_question_ids, question_ids).clip(max=len(self.order) - 1)
+        found = self.sorted_question_ids[positions] == question_ids
+        return self.order[positions[found]]
+
+    def _shards(self):
+        """ Shards of this process and data worker, in this epoch's order """
+        paths = self.paths
+        if self.shuffle:
+            # the same order in every process and worker, so that they split the shards without overlap
+            paths = [paths[i] for i in np.random.RandomState(self.seed + self.epoch).permutation(len(paths))]
+        rank, world_size = self._rank()
+        paths = paths[rank::world_size]
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            paths = paths[worker.id::worker.num_workers]
+        return paths, (self.seed, self.epoch, rank, worker.id if worker is not None else 0)
+
+    def _images(self):
+        paths, rng_seed = self._shards()
+        rng = np.random.RandomState(rng_seed)
+        buffer = []
+        for path in paths:
+            for image_id, image, question_ids in read_shard(path):
+                v, b, obj_mask, width, height = image
+                b = features.rescale_boxes(b, width, height, self.meta['normalized_boxes'])
+                entry = image_id, (v, b, obj_mask, width, height), self._positions(question_ids)
+                if len(buffer) < self.buffer_images:
+                    buffer.append(entry)
+                    continue
+                if buffer:
+                    # hand out a random image of the buffer and put the new one in its place
+                    i = rng.randint(len(buffer))
+                    buffer[i], entry = entry, buffer[i]
+                yield entry
+        for i in rng.permutation(len(buffer)):
+            yield buffer[i]
+
+    def __iter__(self):
+        # questions waiting for a batch, with the image id of each
+        items, owners, images = [], [], {}
+        for image_id, image, positions in self._images():
+            if not len(positions):
+                continue
+            images[image_id] = image
+            items.extend(positions.tolist())
+            owners.extend([image_id] * len(positions))
+            while len(items) >= self.batch_size:
+                yield self.split._get_batch(items[:self.batch_size], images)
+                items, owners = items[self.batch_size:], owners[self.batch_size:]
+                images = {owner: images[owner] for owner in set(owners)}
+        if items:
+            worker = torch.utils.data.get_worker_info()
+            if worker is None or worker.num_workers == 1:
+                yield self.split._get_batch(items, images)
+            else:
+                yield Leftover(items, {owner: images[owner] for owner in set(owners)})
+
+
+class ShardLoader:
+    """ DataLoader over a ShardStream that moves the stream to its next epoch every time it is iterated.
+        Workers are started anew for every epoch, since they iterate over their own copy of the stream.
+        The Leftovers of the workers are packed into batches at the end of the epoch.
+    """
+    def __init__(self, stream, **options):
+        self.stream = stream
+        self.dataset = stream.split
+        options.pop('persistent_workers', None)
+        self.loader = torch.utils.data.DataLoader(stream, batch_size=None, **options)
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.stream)
+
+    def __iter__(self):
+        # set before the iterator is created: workers copy the stream when they start, without workers
+        # the stream is only read once the first batch is fetched
+        self.stream.set_epoch(self.epoch)
+        self.epoch += 1
+        return self._batches(iter(self.loader))
+
+    def _batches(self, batches):
+        items, images = [], {}
+        for batch in batches:
+            if isinstance(batch, Leftover):
+                items.extend(batch.items)
+                images.update(batch.images)
+                continue
+            yield batch
+        batch_size = self.stream.batch_size
+        for start in range(0, len(items), batch_size):
+            yield self.dataset._get_batch(items[start:start + batch_size], images)
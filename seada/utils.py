@@ -4,9 +4,9 @@ import json
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torchvision.transforms as transforms
 
 import config
+from . import features
 
 def process_answer(answer):
     """
@@ -112,6 +112,103 @@ def path_for(train=False, val=False, test=False, question=False, trainval=False,
     return os.path.join(config.qa_path, s)
 
 
+def features_path_for(test=False, shared=True):
+    """ Path of the preprocessed feature store: the node-wide shared-memory copy if configured, else the store of the configured backend """
+    if shared and config.shared_features:
+        return features.shared_features_path(config.shared_features, test=test)
+    if config.feature_backend == 'mmap':
+        return config.preprocessed_test_mmap_path if test else config.preprocessed_trainval_mmap_path
+    return config.preprocessed_test_path if test else config.preprocessed_trainval_path
+
+
+def features_paths_for(test=False):
+    """ Feature store path(s) a split is loaded from: with config.combine_feature_stores the trainval and test stores
+        that exist, opened as one logical store shared by all splits, else the store of the split alone
+    """
+    if config.combine_feature_stores:
+        return [path for path in (features_path_for(), features_path_for(test=True)) if os.path.exists(path)]
+    return features_path_for(test=test)
+
+
+# characters that can follow a complete json value
+_JSON_DELIMITERS = frozenset(',]}: \t\r\n')
+
+
+class _JsonStream:
+    """ Reads json values one at a time from a file, keeping only a small window of it in memory """
+    def __init__(self, fd, block_bytes=1 << 20):
+        self.fd = fd
+        self.block_bytes = block_bytes
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        block = self.fd.read(self.block_bytes)
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+        self.eof = not block
+
+    def peek(self):
+        """ Next non-whitespace character, without consuming it ('' at the end of the file) """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('malformed json: expected one of {!r}, got {!r}'.format(chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            # a number cut off by the end of the window (even inside it, like '2.' or '1e') continues in the next block
+            if not self.eof and (end == len(self.buf) or self.buf[end] not in _JSON_DELIMITERS):
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(path, key):
+    """ Stream the elements of the array under `key` of the top-level object in the json at `path`
+        (or of the top-level array itself), without ever loading the whole file
+    """
+    with open(path, 'r') as fd:
+        stream = _JsonStream(fd)
+        if stream.expect('{[') == '{':
+            while stream.peek() != '}':
+                name = stream.value()
+                stream.expect(':')
+                if name == key:
+                    break
+                # everything besides the array is small, like 'info' and 'license'
+                stream.value()
+                if stream.peek() == ',':
+                    stream.expect(',')
+            else:
+                raise KeyError('{} has no {!r}'.format(path, key))
+            stream.expect('[')
+        while stream.peek() != ']':
+            yield stream.value()
+            if stream.peek() == ',':
+                stream.expect(',')
+
+
 def print_lr(optimizer, prefix, epoch):
     all_rl = []
     for p in optimizer.param_groups:
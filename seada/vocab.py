@@ -0,0 +1,167 @@
+import _pickle as cPickle
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+import config
+
+
+# the vocab of this process, see get and use
+_vocab = None
+
+
+class TokenMap:
+    """ One vocabulary as two arrays: its tokens as sorted fixed-width utf-8 strings and the index of each.
+        Lookups are binary searches over the sorted tokens, a whole sequence of tokens at once.
+    """
+    def __init__(self, tokens, indices):
+        self.tokens = tokens
+        self.indices = indices
+
+    @classmethod
+    def from_dict(cls, token_to_index):
+        tokens = np.array([token.encode('utf-8') for token in token_to_index], dtype='S')
+        indices = np.array(list(token_to_index.values()), dtype='int64')
+        order = np.argsort(tokens, kind='stable')
+        return cls(tokens[order], indices[order])
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __contains__(self, token):
+        return self.encode([token])[0] >= 0
+
+    def encode(self, tokens, unknown=-1):
+        """ Indices of a sequence of tokens as an int64 array, `unknown` for the tokens that are not in the vocab """
+        if not len(tokens) or not len(self):
+            return np.full(len(tokens), unknown, dtype='int64')
+        queries = np.char.encode(np.asarray(tokens, dtype=str), 'utf-8')
+        positions = np.searchsorted(self.tokens, queries).clip(max=len(self) - 1)
+        found = self.tokens[positions] == queries
+        return np.where(found, self.indices[positions], unknown)
+
+    def words(self):
+        """ The tokens in the order of their indices """
+        return [token.decode('utf-8') for token in self.tokens[np.argsort(self.indices, kind='stable')]]
+
+    def to_dict(self):
+        """ token -> index, in the order of the indices like the vocab json, since callers build models from its keys """
+        order = np.argsort(self.indices, kind='stable')
+        return {token.decode('utf-8'): int(index) for token, index in zip(self.tokens[order], self.indices[order])}
+
+
+class Vocab:
+    """ The question and answer vocabularies, compiled into TokenMaps """
+    def __init__(self, question, answer):
+        self.question = question
+        self.answer = answer
+
+    @classmethod
+    def from_json(cls, vocab_json):
+        """ From the {'question': token_to_index, 'answer': answer_to_index} dicts kept in checkpoints """
+        return cls(TokenMap.from_dict(vocab_json['question']), TokenMap.from_dict(vocab_json['answer']))
+
+    def to_json(self):
+        return {'question': self.question.to_dict(), 'answer': self.answer.to_dict()}
+
+    def digest(self):
+        """ Hash of the contents, e.g. to key caches of data encoded with this vocab """
+        h = hashlib.sha1()
+        for array in (self.question.tokens, self.question.indices, self.answer.tokens, self.answer.indices):
+            h.update(array.dtype.str.encode())
+            h.update(np.ascontiguousarray(array).tobytes())
+        return h.hexdigest()
+
+    def save(self, path, meta):
+        """ Store the arrays under `path`, filled under a temporary name and renamed into place like the qa cache.
+            A previous vocab at `path` is renamed aside before it is deleted, so loaders never see it half-deleted.
+        """
+        path = path.rstrip(os.sep)
+        if _read_meta(path) == meta:
+            # already compiled from the same sources, e.g. by a concurrent job
+            return
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, token_map in (('question', self.question), ('answer', self.answer)):
+            np.save(os.path.join(tmp_path, name + '-tokens.npy'), token_map.tokens)
+            np.save(os.path.join(tmp_path, name + '-indices.npy'), token_map.indices)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fd:
+            json.dump(meta, fd)
+        old_path = '{}.old-{}'.format(path, os.getpid())
+        try:
+            os.rename(path, old_path)
+        except OSError:
+            # nothing to replace
+            old_path = None
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process has compiled the same vocab in the meantime
+            shutil.rmtree(tmp_path)
+        if old_path is not None:
+            # processes that have the old vocab mapped keep reading it until they exit
+            shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        def token_map(name):
+            return TokenMap(np.load(os.path.join(path, name + '-tokens.npy'), mmap_mode='r'),
+                            np.load(os.path.join(path, name + '-indices.npy'), mmap_mode='r'))
+        return cls(token_map('question'), token_map('answer'))
+
+
+def _sources():
+    """ What the compiled vocab is built from: the glove word index for questions and the vocabulary json for answers """
+    return [config.glove_index, config.vocabulary_path]
+
+
+def _signature():
+    return [[path, os.path.getsize(path), os.path.getmtime(path)] for path in _sources()]
+
+
+def compile_vocab():
+    """ Compile the vocab files into config.compiled_vocab_path """
+    with open(config.vocabulary_path, 'r') as fd:
+        vocab_json = json.load(fd)
+    with open(config.glove_index, 'rb') as fd:
+        word2idx, idx2word = cPickle.load(fd)
+    vocab_json['question'] = word2idx
+    vocab = Vocab.from_json(vocab_json)
+    vocab.save(config.compiled_vocab_path, {'sources': _signature()})
+    return vocab
+
+
+def _read_meta(path):
+    """ meta.json of the compiled vocab at `path`, None if there is none """
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r') as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def _load_compiled():
+    meta = _read_meta(config.compiled_vocab_path)
+    if meta is not None and meta['sources'] == _signature():
+        return Vocab.load(config.compiled_vocab_path)
+    # missing, or the vocab files have changed since it was compiled
+    return compile_vocab()
+
+
+def get():
+    """ The vocab every dataset of this process uses: the one set with `use`, or else the compiled vocab,
+        memory-mapped once (and compiled first if the vocab files are newer)
+    """
+    global _vocab
+    if _vocab is None:
+        _vocab = _load_compiled()
+    return _vocab
+
+
+def use(vocab_json):
+    """ Make the datasets use the vocab of a checkpoint, given as the dicts of Vocab.to_json """
+    global _vocab
+    _vocab = Vocab.from_json(vocab_json)